@@ -4,19 +4,108 @@ patch_all()
 import sys
 import logging
 
-from gevent import wait, sleep
+from gevent import wait, sleep, spawn
+from gevent.subprocess import Popen
 from getopt import getopt
+from socket import gethostname
 
 from azrpc import AZRPC, AZRPCServer
 
 from .lock import RPCLock
+from .shard import Partitions
 from .slotkeeper import SlotKeeper
+from .ratelimit import RateLimiter
 
 logger = logging.getLogger(__name__)
 
+# Default of --coalesce for every synced service: pushes of an object within
+# that many seconds are merged, 0 merges the pushes of one loop iteration.
+DEFAULT_COALESCE = 0.1
 
-def main(args):
-    opts, args = getopt(args, None, ['log-level=', 'stats-interval=', 'name=', 'port=', 'heartbeat-timeout=', 'all', 'lock', 'slotkeeper'])
+WORKER_CLASSES = {
+    'lock': RPCLock,
+    'slot': SlotKeeper,
+    'ratelimit': RateLimiter,
+}
+
+
+class WorkerStats(object):
+    """Lets the front process of `--workers` collect the worker counters."""
+    def __init__(self, rpc, workers=None, target=None):
+        self.workers = workers
+        self._get_counters = rpc.add(self._get_counters, '%s.counters' % __name__)
+        self._get_counters_execute = lambda *args: self._get_counters.execute(target, *args)
+
+    def _get_counters(self):
+        return dict((name, obj.get_server_counters()) for name, obj in self.workers.iteritems())
+
+    def get_counters(self):
+        return self._get_counters_execute()
+
+
+def create_workers(rpc, opts):
+    workers = dict()
+    coalesce = float(opts.get('--coalesce', DEFAULT_COALESCE))
+    shard = opts.get('--shard')
+    if '--all' in opts or '--lock' in opts:
+        workers['lock'] = RPCLock(rpc, 'lock', shard=shard)
+    if '--all' in opts or '--slotkeeper' in opts:
+        max_queue = opts.get('--max-queue')
+        workers['slot'] = SlotKeeper(rpc, 'slotkeeper', shard=shard, coalesce=coalesce,
+                                     max_queue=None if max_queue is None else int(max_queue),
+                                     slow_policy=opts.get('--slow-policy', 'disconnect'),
+                                     codec=opts.get('--codec'),
+                                     delta='--delta' in opts,
+                                     idle_timeout=float(opts.get('--idle-timeout', 60)))
+    if '--all' in opts or '--ratelimit' in opts:
+        capacity = opts.get('--burst')
+        workers['ratelimit'] = RateLimiter(rpc, 'ratelimit', rate=float(opts.get('--rate', 10)),
+                                           capacity=None if capacity is None else float(capacity),
+                                           shard=shard,
+                                           coalesce=coalesce,
+                                           codec=opts.get('--codec'))
+    return workers
+
+
+def sum_counters(counters):
+    """Adds up a list of `WorkerStats.get_counters` results."""
+    totals = dict()
+    for worker_counters in counters:
+        for name, values in worker_counters.iteritems():
+            total = totals.setdefault(name, dict())
+            for key, value in values.iteritems():
+                total[key] = total.get(key, 0) + value
+    return totals
+
+
+def spawn_worker(args, port, shard):
+    """Starts a worker process with the same options which serves `port`."""
+    return Popen([sys.executable, '-m', 'azsync'] + args + ['--worker-port=%d' % port, '--shard=%s' % shard])
+
+
+def watch_workers(processes, args, shards, interval=1):
+    """Restarts the worker processes of a `{port: process}` dict which exit."""
+    while True:
+        sleep(interval)
+        for port, process in processes.items():
+            if process.poll() is not None:
+                logger.error('Worker on port %s exited with %s, restarting', port, process.returncode)
+                processes[port] = spawn_worker(args, port, shards[port])
+
+
+def run_worker(name, port, heartbeat_timeout, opts):
+    rpc = AZRPC(name, port, heartbeat_timeout=heartbeat_timeout)
+    WorkerStats(rpc, create_workers(rpc, opts))
+    AZRPCServer(rpc)
+    logger.info('Worker listening on port %s', port)
+    try:
+        wait()
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv):
+    opts, args = getopt(argv, None, ['log-level=', 'stats-interval=', 'name=', 'port=', 'heartbeat-timeout=', 'workers=', 'worker-port=', 'shard=', 'coalesce=', 'max-queue=', 'slow-policy=', 'codec=', 'delta', 'idle-timeout=', 'rate=', 'burst=', 'all', 'lock', 'slotkeeper', 'ratelimit'])
     if args:
         print >>sys.stderr, "Invalid arguments: %s" % args
         sys.exit(1)
@@ -29,18 +118,37 @@ def main(args):
     name = opts.pop('--name', 'azsync')
     port = int(opts.pop('--port', 47002))
     heartbeat_timeout = int(opts.pop('--heartbeat-timeout', 10))
+    processes = int(opts.pop('--workers', 0))
+    worker_port = opts.pop('--worker-port', None)
 
-    rpc = AZRPC(name, port, heartbeat_timeout=heartbeat_timeout)
-
-    workers = dict()
-    if '--all' in opts or '--lock' in opts:
-        workers['lock'] = RPCLock(rpc, 'lock')
-    if '--all' in opts or '--slotkeeper' in opts:
-        workers['slot'] = SlotKeeper(rpc, 'slotkeeper')
-    if not workers:
-        print >>sys.stderr, "Use at least one of --lock or --slotkeeper options"
+    if not any(opt in opts for opt in ('--all', '--lock', '--slotkeeper', '--ratelimit')):
+        print >>sys.stderr, "Use at least one of --lock, --slotkeeper or --ratelimit options"
         sys.exit(1)
 
+    if worker_port is not None:
+        run_worker(name, int(worker_port), heartbeat_timeout, opts)
+        return
+
+    worker_processes = dict()
+    if processes > 0:
+        # Every worker serves its own port, the front port only publishes the
+        # worker ports so clients can connect to the right worker directly.
+        # Workers are new processes rather than forks, so the ones restarted
+        # later don't inherit the greenlets of this one.
+        ports = [port + 1 + i for i in xrange(processes)]
+        rpc = AZRPC(name, port, heartbeat_timeout=heartbeat_timeout)
+        partitions = Partitions(rpc, ports, prefix='%s:%s' % (gethostname(), port))
+        # Workers serve their partition key as shard name, see `Sharded`.
+        shards = dict((worker_port, partitions.get_key(i)) for i, worker_port in enumerate(ports))
+        for worker_port in ports:
+            worker_processes[worker_port] = spawn_worker(argv, worker_port, shards[worker_port])
+        spawn(watch_workers, worker_processes, argv, shards)
+
+        worker_stats = [(worker_port, WorkerStats(AZRPC(name, worker_port))) for worker_port in ports]
+    else:
+        rpc = AZRPC(name, port, heartbeat_timeout=heartbeat_timeout)
+        workers = create_workers(rpc, opts)
+
     AZRPCServer(rpc)
     logger.info('Listening on port %s', port)
 
@@ -50,9 +158,24 @@ def main(args):
         else:
             while True:
                 sleep(stats_interval)
-                for name, obj in workers.iteritems():
-                    print >>sys.stderr, name, '-', obj.get_server_stats()
+                if worker_processes:
+                    counters = []
+                    for worker_port, stats in worker_stats:
+                        try:
+                            counters.append(stats.get_counters())
+                        except Exception as e:
+                            logger.warning('Worker on port %s: Getting stats failed: %s', worker_port, e)
+                    for name, total in sum_counters(counters).iteritems():
+                        print >>sys.stderr, name, '-', WORKER_CLASSES[name].format_server_stats(total)
+                else:
+                    for name, obj in workers.iteritems():
+                        print >>sys.stderr, name, '-', obj.get_server_stats()
     except KeyboardInterrupt:
         pass
+    finally:
+        for process in worker_processes.values():
+            if process.poll() is None:
+                process.terminate()
 
-main(sys.argv[1:])
+if __name__ == '__main__':
+    main(sys.argv[1:])
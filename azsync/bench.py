@@ -0,0 +1,76 @@
+"""Compares the wire codecs on `Keeper` shaped records.
+
+    python -m azsync.bench [--records=N] [--rounds=N]
+"""
+import sys
+import cPickle
+
+from time import time
+from getopt import getopt
+
+from .codec import BACKENDS, RecordCodec
+from .slotkeeper import SlotKeeper
+
+
+class PlainPickle(object):
+    """The encoding used before codecs, pickled dicts."""
+    def encode(self, data):
+        return cPickle.dumps(data)
+
+    def decode(self, data):
+        return cPickle.loads(data)
+
+
+def make_records(count):
+    version = int(time() * 1e6)
+    return [{
+        'id': 'account-%d' % i,
+        'max_slots': 10 + i % 50,
+        'slots': i % 10,
+        'workers': i % 25,
+        'max_units': 100 if i % 2 else 0,
+        'units': i % 100 if i % 2 else 0,
+        'unit_waiters': i % 3 if i % 2 else 0,
+        'version': version + i,
+    } for i in xrange(count)]
+
+
+def get_codecs():
+    codecs = [('cpickle-plain', PlainPickle())]
+    for name in BACKENDS:
+        codecs.append(('%s-dict' % name, RecordCodec(None, name)))
+        codecs.append(('%s-record' % name, RecordCodec(SlotKeeper.__sync_members__, name)))
+    return codecs
+
+
+def bench(codec, records, rounds):
+    start = time()
+    for _ in xrange(rounds):
+        encoded = [codec.encode(record) for record in records]
+    encode_time = time() - start
+    start = time()
+    for _ in xrange(rounds):
+        for data in encoded:
+            codec.decode(data)
+    decode_time = time() - start
+    assert codec.decode(encoded[0]) == records[0]
+    count = len(records) * rounds
+    return {
+        'encode': count / encode_time,
+        'decode': count / decode_time,
+        'bytes': float(sum(len(data) for data in encoded)) / len(records),
+    }
+
+
+def main(args=sys.argv[1:]):
+    opts, args = getopt(args, None, ['records=', 'rounds='])
+    opts = dict(opts)
+    records = make_records(int(opts.get('--records', 10000)))
+    rounds = int(opts.get('--rounds', 10))
+    print '%-16s %12s %12s %8s' % ('codec', 'encode/s', 'decode/s', 'bytes')
+    for name, codec in get_codecs():
+        result = bench(codec, records, rounds)
+        print '%-16s %12d %12d %8.1f' % (name, result['encode'], result['decode'], result['bytes'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import marshal
+import cPickle
+import msgpack
+
+from collections import OrderedDict
+
+
+class CodecError(Exception):
+    pass
+
+
+class Backend(object):
+    """Serializer of plain tuples, dicts and scalars. `safe` backends don't
+    run code while decoding data from the network.
+    """
+    def __init__(self, name, tag, dumps, loads, safe=True):
+        self.name = name
+        self.tag = tag
+        self.dumps = dumps
+        self.loads = loads
+        self.safe = safe
+
+
+BACKENDS = OrderedDict()
+TAGS = dict()
+
+
+def register_backend(name, tag, dumps, loads, safe=True):
+    assert len(tag) == 1 and tag not in TAGS, tag
+    BACKENDS[name] = TAGS[tag] = Backend(name, tag, dumps, loads, safe)
+
+
+# marshal isn't meant for untrusted data, malformed input can crash the
+# interpreter.
+register_backend('pickle', 'p', lambda obj: cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL), cPickle.loads, safe=False)
+register_backend('marshal', 'm', lambda obj: marshal.dumps(obj, 2), marshal.loads, safe=False)
+# Byte strings and unicode strings are kept apart.
+register_backend('msgpack', 'k', lambda obj: msgpack.packb(obj, use_bin_type=True),
+                 lambda data: msgpack.unpackb(data, raw=False, use_list=False))
+
+DEFAULT_BACKEND = 'msgpack'
+
+
+class RecordCodec(object):
+    """Encodes dicts with the keys `members` as a tuple of a bit mask of the
+    present keys followed by their values in `members` order, so records can
+    leave out keys. Other keys are dropped. Without `members` the dict is
+    encoded as it is.
+
+    Encoded records start with the tag of their backend. Decoding accepts
+    every safe backend and unsafe ones only when it is the backend of the
+    codec. `backend` defaults to msgpack. None of the backends is compatible
+    with peers from before codecs, which sent plain pickled dicts, not even
+    pickle, so all peers have to be upgraded together.
+    """
+    def __init__(self, members=None, backend=None):
+        if backend is None:
+            backend = DEFAULT_BACKEND
+        if backend not in BACKENDS:
+            raise CodecError('Unknown backend: %s' % backend)
+        self.members = tuple(members) if members is not None else None
+        self.full = (1 << len(self.members)) - 1 if members is not None else None
+        self.backend = BACKENDS[backend]
+
+    def encode(self, data):
+        if self.members is None:
+            return self.backend.tag + self.backend.dumps(data)
+        try:
+            values = (self.full,) + tuple([data[key] for key in self.members])
+        except KeyError:
+            mask = 0
+            values = [None]
+            for i, key in enumerate(self.members):
+                if key in data:
+                    mask |= 1 << i
+                    values.append(data[key])
+            values[0] = mask
+            values = tuple(values)
+        return self.backend.tag + self.backend.dumps(values)
+
+    def decode(self, data):
+        backend = TAGS.get(data[:1])
+        if backend is None:
+            raise CodecError('Unknown backend tag: %r' % data[:1])
+        if not backend.safe and backend is not self.backend:
+            raise CodecError('Backend not allowed: %s' % backend.name)
+        values = backend.loads(data[1:])
+        if self.members is None:
+            return values
+        mask = values[0]
+        if mask == self.full:
+            return dict(zip(self.members, values[1:]))
+        record = dict()
+        i = 1
+        for bit, key in enumerate(self.members):
+            if mask & (1 << bit):
+                record[key] = values[i]
+                i += 1
+        return record
+
+
+_codecs = dict()
+
+
+def get_codec(members=None, backend=None):
+    """Returns a shared `RecordCodec`."""
+    key = (tuple(members) if members is not None else None, backend or DEFAULT_BACKEND)
+    codec = _codecs.get(key)
+    if codec is None:
+        codec = _codecs[key] = RecordCodec(members, backend)
+    return codec
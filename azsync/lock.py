@@ -1,32 +1,194 @@
 import logging
 
-from gevent import GreenletExit, Timeout
+from time import time
+from gevent import GreenletExit, Timeout, spawn, sleep, getcurrent
 from gevent.lock import Semaphore
+from gevent.event import Event
+from collections import deque
 from contextlib import contextmanager
+from itertools import count
+from uuid import uuid4
 from weakref import WeakValueDictionary, WeakSet
 
 from azrpc import AZRPCTimeout
 
+from .sync import RPCSync
+from .wheel import TimerWheel
+
 logger = logging.getLogger(__name__)
 
 
 # Helper classes
 
-class MySemaphore(object):
-    def __init__(self):
-        self.sema = Semaphore()
+class Ticket(object):
+    def __init__(self, shared, token=None):
+        self.shared = shared
+        self.token = token
+        self.granted = False
+        self.event = Event()
+
+
+class MyLock(object):
+    """Shared/exclusive lock which grants waiters in strict FIFO order. New
+    readers queue up behind a waiting writer so writers can't starve.
+    `on_change` is called whenever the holders change. The queue is created
+    with the first waiter, most locks never have one.
+    """
+    __slots__ = ('name', 'on_change', 'readers', 'writer', 'queue', '__weakref__')
+
+    def __init__(self, name=None, on_change=None):
+        self.name = name
+        self.on_change = on_change
+        self.readers = 0
+        self.writer = False
+        self.queue = None
+
+    @property
+    def waiters(self):
+        return len(self.queue) if self.queue else 0
+
+    def _compatible(self, shared):
+        if shared:
+            return not self.writer
+        return not self.writer and self.readers == 0
+
+    def _wake(self):
+        granted = False
+        while self.queue and self._compatible(self.queue[0].shared):
+            ticket = self.queue.popleft()
+            if ticket.shared:
+                self.readers += 1
+            else:
+                self.writer = True
+            ticket.granted = True
+            ticket.event.set()
+            granted = True
+        return granted
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def acquire(self, blocking=True, shared=False, timeout=None, token=None):
+        """Returns `True` when the lock was acquired and `False` when it wasn't
+        possible without blocking or within `timeout` seconds.
+        """
+        if not self.queue and self._compatible(shared):
+            if shared:
+                self.readers += 1
+            else:
+                self.writer = True
+            self._changed()
+            return True
+        if not blocking:
+            return False
+        ticket = Ticket(shared, token)
+        if self.queue is None:
+            self.queue = deque()
+        self.queue.append(ticket)
+        try:
+            ticket.event.wait(timeout)
+        except:
+            self._cancel(ticket)
+            raise
+        if not ticket.granted:
+            self._cancel(ticket)
+            return False
+        return True
+
+    def _cancel(self, ticket):
+        if ticket.granted:
+            self.release(ticket.shared)
+        else:
+            self.queue.remove(ticket)
+            if self._wake():
+                self._changed()
+
+    def release(self, shared=False):
+        if shared:
+            assert self.readers > 0
+            self.readers -= 1
+        else:
+            assert self.writer
+            self.writer = False
+        self._wake()
+        self._changed()
+
+    def locked(self):
+        return self.writer or self.readers > 0
+
+    def position(self, token):
+        """Returns the zero based queue position of the waiter with `token` or
+        `None` when it isn't waiting.
+        """
+        for i, ticket in enumerate(self.queue or ()):
+            if ticket.token == token:
+                return i
+        return None
+
+    def state(self):
+        return {
+            'locked': self.locked(),
+            'holders': self.readers + (1 if self.writer else 0),
+            'readers': self.readers,
+            'writer': self.writer,
+            'waiters': self.waiters,
+        }
 
 
 class Waiter(object):
     pass
 
 
+class Holder(object):
+    """Acquired locks of a stream which can be released once, either by the
+    stream ending or an explicit release request.
+    """
+    __slots__ = ('locks', 'shared', 'released', '__weakref__')
+
+    def __init__(self, locks, shared):
+        self.locks = locks
+        self.shared = shared
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return False
+        self.released = True
+        for lock in reversed(self.locks):
+            lock.release(self.shared)
+        return True
+
+
+class MasterLease(object):
+    __slots__ = ('token', 'name', 'holder', 'expires', 'wheel_slot')
+
+    def __init__(self, token, name, holder, expires):
+        self.token = token
+        self.name = name
+        self.holder = holder
+        self.expires = expires
+
+
+class MasterSession(object):
+    def __init__(self, id):
+        self.id = id
+        self.closed = False
+        self.held = dict()
+        # Greenlets of queued acquires by token, killed to cancel them.
+        self.pending = dict()
+
+
 # Main RPC class
 
 class RPCLock(object):
-    def __init__(self, rpc, name, target=None):
+    """Lock service. `shard` suffixes the RPC names, so the shards of a
+    `ShardedRPCLock` don't share them. The `LockWatch` master is only created
+    when the first follower of `watch_locks` connects to the server.
+    """
+    def __init__(self, rpc, name, target=None, shard=None):
         self.rpc = rpc
-        self.name = '%s.%s' % (__name__, name)
+        self.name = '%s.%s' % (__name__, name) if shard is None else '%s.%s/%s' % (__name__, name, shard)
 
         self.stats = {
             'requests': 0,
@@ -39,40 +201,123 @@ class RPCLock(object):
             'failed': 0,
             'failed_timeout': 0,
             'exceptions': 0,
+            'sessions': 0,
+            'sessions_timeout': 0,
+            'shared': 0,
+            'wait_timeout': 0,
+            'leases': 0,
+            'leases_renewed': 0,
+            'leases_expired': 0,
         }
 
         self.lock = Semaphore()
         self.locks = WeakValueDictionary()
         self.waiting = WeakSet()
+        self.holders = WeakValueDictionary()
+        self.leases = dict()
+        self.lease_wheel = TimerWheel(self._expire_lease)
+        # Fences are `(epoch, n)` tuples, the epoch of a restarted server is
+        # higher however many fences the last one handed out.
+        self.fence_epoch = int(time() * 1000000)
+        self.fences = count(1)
+        self.sessions = dict()
+        self.session = None
+        self.local_locks = None
+        self.target = target
+        self.watch = None
+        self._watch_push_loop = rpc.add(self._watch_push_loop, LockWatch.get_rpc_name(self.name))
 
         self._get_lock = rpc.add(self._get_lock, '%s.get_lock' % self.name)
         self._get_lock_stream_sync = lambda *args: self._get_lock.stream_sync(target, *args)
 
+        self._get_locks = rpc.add(self._get_locks, '%s.get_locks' % self.name)
+        self._get_locks_stream_sync = lambda *args: self._get_locks.stream_sync(target, *args)
+
+        self._release = rpc.add(self._release, '%s.release' % self.name)
+        self._release_execute = lambda *args: self._release.execute(target, *args)
+
+        self._lease = rpc.add(self._lease, '%s.lease' % self.name)
+        self._lease_execute = lambda *args: self._lease.execute(target, *args)
+
+        self._renew = rpc.add(self._renew, '%s.renew' % self.name)
+        self._renew_execute = lambda *args: self._renew.execute(target, *args)
+
         self._is_locked = rpc.add(self._is_locked, '%s.is_locked' % self.name)
-        self._is_locked_execute = lambda *args: self.is_locked.execute(target, *args)
+        self._is_locked_execute = lambda *args: self._is_locked.execute(target, *args)
 
-    def get_server_stats(self):
-        stats = (
+        self._queue_position = rpc.add(self._queue_position, '%s.queue_position' % self.name)
+        self._queue_position_execute = lambda *args: self._queue_position.execute(target, *args)
+
+        self._lock_states = rpc.add(self._lock_states, '%s.lock_states' % self.name)
+        self._lock_states_execute = lambda *args: self._lock_states.execute(target, *args)
+
+        self._session = rpc.add(self._session, '%s.session' % self.name)
+        self._session_stream_sync = lambda *args: self._session.stream_sync(target, *args)
+
+        self._session_acquire = rpc.add(self._session_acquire, '%s.session_acquire' % self.name)
+        self._session_acquire_execute = lambda *args: self._session_acquire.execute(target, *args)
+
+        self._session_release = rpc.add(self._session_release, '%s.session_release' % self.name)
+        self._session_release_execute = lambda *args: self._session_release.execute(target, *args)
+
+    def get_server_counters(self):
+        counters = dict(self.stats)
+        counters.update(
+            active=len(self.locks),
+            active_leases=len(self.leases),
+            active_sessions=len(self.sessions),
+            readers=sum(lock.readers for lock in self.locks.values()),
+            writers=sum(1 for lock in self.locks.values() if lock.writer),
+            waiting=len(self.waiting))
+        return counters
+
+    @staticmethod
+    def format_server_stats(counters):
+        return (
             '{requests} requests, {already_locked} already_locked, '
-            '{waiting} waiting, {active} active, '
+            '{waiting} waiting, {active} active, {active_sessions} active sessions, '
+            '{readers} readers, {writers} writers, {shared} shared, '
             '{try_failed} try_failed, {acquired} acquired, {released} released, '
-            '{timeout} timeout, {unexpected} unexpected, '
+            '{timeout} timeout, {wait_timeout} wait_timeout, {unexpected} unexpected, '
             '{failed} failed, {failed_timeout} failed_timeout, '
-            '{exceptions} exceptions'.format(
-                active=len(self.locks),
-                waiting=len(self.waiting),
-                **self.stats))
-        return stats
+            '{exceptions} exceptions, {sessions} sessions, {sessions_timeout} sessions_timeout, '
+            '{active_leases} active leases, {leases} leases, {leases_renewed} leases_renewed, '
+            '{leases_expired} leases_expired'.format(**counters))
 
-    def _get_lock(self, name, try_=False):
-        self.stats['requests'] += 1
+    def get_server_stats(self):
+        return self.format_server_stats(self.get_server_counters())
+
+    def _get_my_lock(self, name):
         with self.lock:
             if name not in self.locks:
-                lock = MySemaphore()
+                lock = MyLock(name, self._lock_changed)
                 self.locks[name] = lock
             else:
                 lock = self.locks[name]
-        if lock.sema.locked():
+        return lock
+
+    def _lock_changed(self, lock):
+        # Without a watch nobody ever watched the locks.
+        if self.watch is not None:
+            self.watch.publish(lock)
+
+    def _watch_push_loop(self, *args):
+        if self.watch is None:
+            self.watch = LockWatch(None, self.name, locks=self.locks)
+        push_loop = self.watch._push_loop(*args)
+        try:
+            for item in push_loop:
+                yield item
+        finally:
+            push_loop.close()
+
+    def _get_lock(self, name, try_=False, shared=False, timeout=None, token=None):
+        self.stats['requests'] += 1
+        if shared:
+            self.stats['shared'] += 1
+        lock = self._get_my_lock(name)
+        got = lock.acquire(blocking=False, shared=shared)
+        if not got:
             self.stats['already_locked'] += 1
             if try_:
                 self.stats['try_failed'] += 1
@@ -80,24 +325,39 @@ class RPCLock(object):
                 return
         logger.debug('%s: Trying to acquire', name)
         try:
-            waiter = Waiter()
-            self.waiting.add(waiter)
-            with lock.sema:
+            if not got:
+                waiter = Waiter()
+                self.waiting.add(waiter)
+                got = lock.acquire(shared=shared, timeout=timeout, token=token)
                 del waiter
+                if not got:
+                    self.stats['wait_timeout'] += 1
+                    logger.debug('%s: Timed out waiting for lock', name)
+                    yield False
+                    return
+            holder = Holder([lock], shared)
+            if token is not None:
+                self.holders[token] = holder
+            try:
                 self.stats['acquired'] += 1
                 logger.debug('%s: Acquired', name)
                 try:
                     while True:
                         yield True
                 except (GeneratorExit, GreenletExit):
-                    self.stats['released'] += 1
-                    logger.debug('%s: Released', name)
+                    # Locks released with `_release` are counted there.
+                    if holder.release():
+                        self.stats['released'] += 1
+                        logger.debug('%s: Released', name)
                 except AZRPCTimeout:
-                    self.stats['timeout'] += 1
-                    logger.info('%s: Timed out', name)
+                    if holder.release():
+                        self.stats['timeout'] += 1
+                        logger.info('%s: Timed out', name)
                 else:
                     self.stats['unexpected'] += 1
                     logger.warning('%s: Released without error', name)
+            finally:
+                holder.release()
         except (GeneratorExit, GreenletExit):
             self.stats['failed'] += 1
             logger.warning('%s: Released before getting lock', name)
@@ -109,28 +369,433 @@ class RPCLock(object):
             logger.exception('Exception at lock %s', name)
             raise
 
+    def _get_locks(self, names, try_=False, shared=False, timeout=None, token=None):
+        """Acquires all `names` or none of them. The locks are taken in sorted
+        order so overlapping requests can't deadlock each other.
+        """
+        self.stats['requests'] += 1
+        if shared:
+            self.stats['shared'] += 1
+        names = sorted(set(names))
+        locks = [self._get_my_lock(name) for name in names]
+        held = []
+        try:
+            for lock in locks:
+                if not lock.acquire(blocking=False, shared=shared):
+                    break
+                held.append(lock)
+            if len(held) != len(locks):
+                self.stats['already_locked'] += 1
+                if try_:
+                    while held:
+                        held.pop().release(shared)
+                    self.stats['try_failed'] += 1
+                    yield False
+                    return
+            logger.debug('%s: Trying to acquire', names)
+            try:
+                waiter = Waiter()
+                self.waiting.add(waiter)
+                deadline = None if timeout is None else time() + timeout
+                for lock in locks[len(held):]:
+                    remaining = None if deadline is None else max(0, deadline - time())
+                    if not lock.acquire(shared=shared, timeout=remaining, token=token):
+                        break
+                    held.append(lock)
+                del waiter
+                if len(held) != len(locks):
+                    self.stats['wait_timeout'] += 1
+                    logger.debug('%s: Timed out waiting for locks', names)
+                    while held:
+                        held.pop().release(shared)
+                    yield False
+                    return
+                holder = Holder(held, shared)
+                held = []
+                if token is not None:
+                    self.holders[token] = holder
+                self.stats['acquired'] += len(holder.locks)
+                logger.debug('%s: Acquired', names)
+                try:
+                    while True:
+                        yield True
+                except (GeneratorExit, GreenletExit):
+                    if holder.release():
+                        self.stats['released'] += len(holder.locks)
+                        logger.debug('%s: Released', names)
+                except AZRPCTimeout:
+                    if holder.release():
+                        self.stats['timeout'] += 1
+                        logger.info('%s: Timed out', names)
+                else:
+                    self.stats['unexpected'] += 1
+                    logger.warning('%s: Released without error', names)
+                finally:
+                    holder.release()
+            except (GeneratorExit, GreenletExit):
+                self.stats['failed'] += 1
+                logger.warning('%s: Released before getting locks', names)
+            except AZRPCTimeout:
+                self.stats['failed_timeout'] += 1
+                logger.warning('%s: Timed out before getting locks', names)
+            except:
+                self.stats['exceptions'] += 1
+                logger.exception('Exception at locks %s', names)
+                raise
+        finally:
+            while held:
+                held.pop().release(shared)
+
+    def _release(self, token):
+        """Releases the locks of the stream or lease with `token` before the
+        stream itself is closed. Returns `False` when they weren't held anymore.
+        """
+        lease = self.leases.pop(token, None)
+        if lease is not None:
+            self.lease_wheel.discard(lease)
+            logger.debug('%s: Released lease', lease.name)
+        holder = self.holders.get(token)
+        if holder is None or not holder.release():
+            return False
+        self.stats['released'] += len(holder.locks)
+        return True
+
+    def _lease(self, name, ttl, try_=False, shared=False, timeout=None):
+        """Acquires a lock which isn't bound to a stream but expires after `ttl`
+        seconds unless it is renewed. Returns a dict with the lease `token`, a
+        `fence` token which is higher than the ones of all earlier leases, also
+        of earlier runs of the server, and the server time the lease `expires`,
+        or `None` when not acquired.
+        """
+        self.stats['requests'] += 1
+        if shared:
+            self.stats['shared'] += 1
+        lock = self._get_my_lock(name)
+        if not lock.acquire(blocking=False, shared=shared):
+            self.stats['already_locked'] += 1
+            if try_:
+                self.stats['try_failed'] += 1
+                return None
+            waiter = Waiter()
+            self.waiting.add(waiter)
+            got = lock.acquire(shared=shared, timeout=timeout)
+            del waiter
+            if not got:
+                self.stats['wait_timeout'] += 1
+                logger.debug('%s: Timed out waiting for lease', name)
+                return None
+        token = uuid4().hex
+        lease = MasterLease(token, name, Holder([lock], shared), time() + ttl)
+        self.holders[token] = lease.holder
+        self.leases[token] = lease
+        self.lease_wheel.add(lease)
+        self.stats['acquired'] += 1
+        self.stats['leases'] += 1
+        logger.debug('%s: Leased for %ss', name, ttl)
+        return {
+            'token': token,
+            'fence': (self.fence_epoch, next(self.fences)),
+            'expires': lease.expires,
+        }
+
+    def _renew(self, leases):
+        """Renews a list of `(token, ttl)` leases. Returns the new expiry time
+        of each lease or `None` for leases which are gone.
+        """
+        now = time()
+        result = []
+        for token, ttl in leases:
+            lease = self.leases.get(token)
+            if lease is None:
+                result.append(None)
+            else:
+                lease.expires = now + ttl
+                self.stats['leases_renewed'] += 1
+                result.append(lease.expires)
+        return result
+
+    def _expire_lease(self, lease):
+        if self.leases.pop(lease.token, None) is None:
+            return
+        self.stats['leases_expired'] += 1
+        logger.info('%s: Lease expired', lease.name)
+        lease.holder.release()
+
     def _is_locked(self, name):
         with self.lock:
             if name not in self.locks:
                 return False
             lock = self.locks[name]
-        return lock.sema.locked()
+        return lock.locked()
+
+    def _queue_position(self, name, token):
+        lock = self.locks.get(name)
+        if lock is None:
+            return None
+        return lock.position(token)
+
+    def _lock_states(self, names):
+        """Returns a dict with the state of every name in `names`."""
+        states = dict()
+        for name in names:
+            lock = self.locks.get(name)
+            if lock is None:
+                states[name] = {'locked': False, 'holders': 0, 'readers': 0, 'writer': False, 'waiters': 0}
+            else:
+                states[name] = lock.state()
+        return states
+
+    def _session(self, session_id):
+        self.stats['sessions'] += 1
+        session = MasterSession(session_id)
+        with self.lock:
+            assert session_id not in self.sessions, session_id
+            self.sessions[session_id] = session
+        logger.debug('%s: Session opened', session_id)
+        try:
+            try:
+                while True:
+                    yield True
+            except (GeneratorExit, GreenletExit):
+                logger.debug('%s: Session closed', session_id)
+            except AZRPCTimeout:
+                self.stats['sessions_timeout'] += 1
+                logger.info('%s: Session timed out', session_id)
+            else:
+                self.stats['unexpected'] += 1
+                logger.warning('%s: Session closed without error', session_id)
+        finally:
+            session.closed = True
+            with self.lock:
+                del self.sessions[session_id]
+            for greenlet in session.pending.values():
+                greenlet.kill(block=False)
+            for name, lock, shared in session.held.values():
+                lock.release(shared)
+                self.stats['released'] += 1
+                logger.debug('%s: Released with session %s', name, session_id)
+            session.held.clear()
+
+    def _session_acquire(self, session_id, token, name, try_=False, shared=False, timeout=None):
+        """Acquires a lock on behalf of a session. The lock stays held until it
+        is released with `_session_release` or the session stream ends. Both
+        also cancel the acquire while it is queued.
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise RuntimeError('Unknown session: %s' % session_id)
+        assert token not in session.held, token
+        self.stats['requests'] += 1
+        if shared:
+            self.stats['shared'] += 1
+        lock = self._get_my_lock(name)
+        if not lock.acquire(blocking=False, shared=shared):
+            self.stats['already_locked'] += 1
+            if try_:
+                self.stats['try_failed'] += 1
+                return False
+            logger.debug('%s: Trying to acquire with session %s', name, session_id)
+            waiter = Waiter()
+            self.waiting.add(waiter)
+            session.pending[token] = getcurrent()
+            try:
+                got = lock.acquire(shared=shared, timeout=timeout)
+            except GreenletExit:
+                self.stats['failed'] += 1
+                logger.debug('%s: Cancelled waiting for lock with session %s', name, session_id)
+                return False
+            finally:
+                session.pending.pop(token, None)
+            del waiter
+            if not got:
+                self.stats['wait_timeout'] += 1
+                logger.debug('%s: Timed out waiting for lock with session %s', name, session_id)
+                return False
+        if session.closed:
+            lock.release(shared)
+            self.stats['failed'] += 1
+            logger.warning('%s: Session %s closed before getting lock', name, session_id)
+            return False
+        session.held[token] = (name, lock, shared)
+        self.stats['acquired'] += 1
+        logger.debug('%s: Acquired with session %s', name, session_id)
+        return True
+
+    def _session_release(self, session_id, token):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return False
+        if token in session.pending:
+            session.pending[token].kill(block=False)
+            return False
+        if token not in session.held:
+            return False
+        name, lock, shared = session.held.pop(token)
+        lock.release(shared)
+        self.stats['released'] += 1
+        logger.debug('%s: Released with session %s', name, session_id)
+        return True
 
     # Client functions
 
     @contextmanager
-    def get_lock(self, name, try_=False):
+    def get_lock(self, name, try_=False, session=False, shared=False, timeout=None, ack=True, local=False):
         """Acquires or tries to acquire the lock. Returns `True` when the lock is
-        acquired.
+        acquired. With `session` the lock is held by the shared process session
+        instead of an own stream. With `shared` the lock is acquired in shared
+        mode and only excludes non-shared holders. With `timeout` the server
+        gives up waiting after that many seconds. Without `ack` the release
+        doesn't wait for the server to confirm it. With `local` all greenlets of
+        this process share one remote acquisition of the name, see `LocalLocks`.
         """
-        lock = Lock(self, name, try_)
+        if local:
+            assert not session and not shared, 'Local locks are exclusive stream locks'
+            lock = LocalLock(self.get_local_locks(), name, try_, timeout)
+        elif session:
+            lock = SessionLock(self.get_session(), name, try_, shared, timeout, ack)
+        else:
+            lock = Lock(self, name, try_, shared, timeout, ack)
         with lock as got_lock:
             yield got_lock
 
+    @contextmanager
+    def get_locks(self, names, try_=False, shared=False, timeout=None, ack=True):
+        """Acquires or tries to acquire all locks at once. Returns `True` when
+        every lock is acquired.
+        """
+        lock = Locks(self, names, try_, shared, timeout, ack)
+        with lock as got_lock:
+            yield got_lock
+
+    def get_session(self):
+        """Returns the session of this process which is shared by all session
+        locks. All locks of a session are released when its stream ends.
+        """
+        if self.session is None:
+            self.session = Session(self)
+        return self.session
+
+    def get_local_locks(self, max_handoffs=None):
+        if self.local_locks is None:
+            self.local_locks = LocalLocks(self)
+        if max_handoffs is not None:
+            self.local_locks.max_handoffs = max_handoffs
+        return self.local_locks
+
+    def get_lease(self, name, ttl, try_=False, shared=False, timeout=None):
+        """Returns a `Lease` for the name, see `_lease`."""
+        return Lease(self, name, ttl, try_, shared, timeout)
+
+    def renew_leases(self, leases):
+        """Renews many leases with a single request. Returns the leases which
+        couldn't be renewed anymore.
+        """
+        leases = [lease for lease in leases if lease.got]
+        if not leases:
+            return []
+        expired = []
+        result = self._renew_execute([(lease.token, lease.ttl) for lease in leases])
+        for lease, expires in zip(leases, result):
+            if expires is None:
+                lease.got = False
+                expired.append(lease)
+            else:
+                lease.expires = expires
+        return expired
+
+    def watch_locks(self, callback, names=None, prefixes=None, instance_id=None):
+        """Calls `callback(name, state)` whenever one of the `names` or a name
+        starting with one of the `prefixes` gets locked or changes its holders.
+        `state` is `None` when the name got unlocked. Without `names` and
+        `prefixes` all names are watched. Returns the started `LockWatch`, use
+        its `stop` method to end watching.
+        """
+        watch = LockWatch(self.rpc, self.name, instance_id or uuid4().hex, self.target,
+                          callback=callback, ids=names, prefixes=prefixes)
+        watch.start()
+        return watch
+
     def locked(self, name):
         return self._is_locked_execute(name)
     is_locked = locked
 
+    def lock_states(self, names):
+        """Returns a dict with `locked`, `holders` and `waiters` of every name
+        with a single request.
+        """
+        return self._lock_states_execute(list(names))
+
+    def locked_many(self, names):
+        return dict((name, state['locked']) for name, state in self.lock_states(names).iteritems())
+    are_locked = locked_many
+
+
+# Lock state sync
+
+class LockWatch(RPCSync):
+    """Pushes the state of all locked names to watching followers. The master
+    only publishes changes while followers are connected, new followers get a
+    snapshot of the `locks` map.
+    """
+    __sync_members__ = ('id', 'locked', 'holders', 'readers', 'writer', 'waiters')
+
+    def __init__(self, rpc, name, instance_id=None, target=None, callback=None, ids=None, prefixes=None, locks=None):
+        super(LockWatch, self).__init__(rpc, name, instance_id, target, ids, prefixes)
+        self.callback = callback
+        self.locks = locks
+        self.objects = dict()
+
+    @staticmethod
+    def serialize(lock):
+        state = lock.state()
+        state['id'] = lock.name
+        return state
+
+    def publish(self, lock):
+        assert self.is_master
+        if not self._listeners:
+            # Nobody would get the change, but followers mustn't resume over
+            # it, so the history and states go and the sequence id moves on.
+            if self._history or self._states:
+                with self._lock:
+                    self._history.clear()
+                    self._states = dict()
+                    self._states_readers = 0
+            self._seq += 1
+            return
+        if lock.locked():
+            self.add('update', self.serialize(lock))
+        else:
+            self.add('del', lock.name)
+
+    def on_init_push_loop(self, listener):
+        # Only the items are taken with the push lock held, the states are
+        # read while the snapshot is sent. Changes since then are queued after
+        # it anyway.
+        items = self.locks.items()
+        return ((name, self.serialize(lock)) for name, lock in items
+                if (not listener.filtered or listener.wants(name)) and lock.locked())
+
+    def get_all_ids(self):
+        assert not self.is_master
+        return self.objects.keys()
+
+    def on_not_found_ids(self, ids):
+        assert not self.is_master
+        for id in ids:
+            self.on_delete(id)
+
+    def on_update(self, data):
+        assert not self.is_master
+        self.objects[data['id']] = data
+        if self.callback is not None:
+            self.callback(data['id'], data)
+
+    def on_delete(self, id):
+        assert not self.is_master
+        if self.objects.pop(id, None) is not None and self.callback is not None:
+            self.callback(id, None)
+
 
 # Client lock helper class
 
@@ -138,31 +803,46 @@ class Lock(object):
     gen = None
     got = False
 
-    def __init__(self, rpc_lock, name, try_=False):
+    def __init__(self, rpc_lock, name, try_=False, shared=False, timeout=None, ack=True):
         self.rpc_lock = rpc_lock
         self.name = name
         self.try_ = try_
+        self.shared = shared
+        self.timeout = timeout
+        self.ack = ack
+        self.token = uuid4().hex
 
     def acquire(self):
-        self.gen = self.rpc_lock._get_lock_stream_sync(self.name, self.try_)
+        self.gen = self.rpc_lock._get_lock_stream_sync(self.name, self.try_, self.shared, self.timeout, self.token)
         self.got = next(self.gen)
         return self.got
 
     def release(self):
+        """Releases the lock. With `ack` the server confirms the release before
+        the stream is closed, otherwise closing the stream releases it in the
+        background.
+        """
         assert self.got
         if self.got:
             self.got = False
+            if self.ack:
+                try:
+                    with Timeout(1):
+                        self.rpc_lock._release_execute(self.token)
+                except Exception:
+                    pass
             del self.gen
-            try:
-                with Timeout(1):
-                    self.locked()
-            except Exception:
-                pass
 
     def locked(self):
         return self.rpc_lock._is_locked_execute(self.name)
     is_locked = locked
 
+    def position(self):
+        """Returns the zero based position in the wait queue while `acquire` is
+        blocking or `None` when not waiting.
+        """
+        return self.rpc_lock._queue_position_execute(self.name, self.token)
+
     def idle(self):
         assert self.got
         try:
@@ -176,3 +856,303 @@ class Lock(object):
     def __exit__(self, type, value, traceback):
         if self.got:
             self.release()
+
+
+class Locks(Lock):
+    def __init__(self, rpc_lock, names, try_=False, shared=False, timeout=None, ack=True):
+        super(Locks, self).__init__(rpc_lock, None, try_, shared, timeout, ack)
+        self.names = list(names)
+
+    def acquire(self):
+        self.gen = self.rpc_lock._get_locks_stream_sync(self.names, self.try_, self.shared, self.timeout, self.token)
+        self.got = next(self.gen)
+        return self.got
+
+    def locked(self):
+        return any(self.rpc_lock.locked_many(self.names).itervalues())
+    is_locked = locked
+
+    def position(self):
+        for name in self.names:
+            position = self.rpc_lock._queue_position_execute(name, self.token)
+            if position is not None:
+                return position
+        return None
+
+
+class Lease(object):
+    """A lock which expires after `ttl` seconds unless renewed. `fence` is an
+    `(epoch, n)` tuple which increases with every lease the server grants and
+    can be passed to storage to reject writes of holders whose lease already
+    expired.
+    """
+    token = None
+    fence = None
+    expires = None
+    got = False
+
+    def __init__(self, rpc_lock, name, ttl, try_=False, shared=False, timeout=None):
+        self.rpc_lock = rpc_lock
+        self.name = name
+        self.ttl = ttl
+        self.try_ = try_
+        self.shared = shared
+        self.timeout = timeout
+
+    def acquire(self):
+        result = self.rpc_lock._lease_execute(self.name, self.ttl, self.try_, self.shared, self.timeout)
+        if result is None:
+            return False
+        self.token = result['token']
+        self.fence = tuple(result['fence'])
+        self.expires = result['expires']
+        self.got = True
+        return True
+
+    def release(self):
+        assert self.got
+        if self.got:
+            self.got = False
+            self.rpc_lock._release_execute(self.token)
+
+    def renew(self):
+        assert self.got
+        if self.rpc_lock.renew_leases([self]):
+            raise AZRPCTimeout('Lease expired')
+    idle = renew
+
+    def locked(self):
+        return self.rpc_lock._is_locked_execute(self.name)
+    is_locked = locked
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        if self.got:
+            self.release()
+
+
+# Client session helper classes
+
+class Session(object):
+    """A single stream which keeps all session locks of this process alive."""
+    id = None
+    gen = None
+    greenlet = None
+
+    def __init__(self, rpc_lock, interval=1):
+        self.rpc_lock = rpc_lock
+        self.interval = interval
+        self.tokens = count()
+        self.lock = Semaphore()
+
+    @property
+    def alive(self):
+        return self.greenlet is not None and not self.greenlet.dead
+
+    def start(self):
+        with self.lock:
+            if self.alive:
+                return
+            self.id = uuid4().hex
+            self.gen = self.rpc_lock._session_stream_sync(self.id)
+            next(self.gen)
+            self.greenlet = spawn(self._keepalive, self.gen)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        self.gen = None
+
+    def _keepalive(self, gen):
+        try:
+            while True:
+                sleep(self.interval)
+                next(gen)
+        except StopIteration:
+            logger.warning('Session %s: Stream closed', self.id)
+        except AZRPCTimeout:
+            logger.warning('Session %s: Timed out', self.id)
+
+    def acquire(self, name, try_=False, shared=False, timeout=None):
+        """Returns a `(session_id, token)` tuple when the lock was acquired or
+        `None` otherwise.
+        """
+        self.start()
+        session_id = self.id
+        token = next(self.tokens)
+        try:
+            got = self.rpc_lock._session_acquire_execute(session_id, token, name, try_, shared, timeout)
+        except:
+            # The server may still wait for the lock or even have acquired it
+            # for the session, cancel or release it.
+            spawn(self.release, session_id, token)
+            raise
+        if got:
+            return session_id, token
+        return None
+
+    def release(self, session_id, token):
+        if session_id != self.id or not self.alive:
+            return False
+        return self.rpc_lock._session_release_execute(session_id, token)
+
+
+class SessionLock(object):
+    handle = None
+    got = False
+
+    def __init__(self, session, name, try_=False, shared=False, timeout=None, ack=True):
+        self.session = session
+        self.name = name
+        self.try_ = try_
+        self.shared = shared
+        self.timeout = timeout
+        self.ack = ack
+
+    def acquire(self):
+        self.handle = self.session.acquire(self.name, self.try_, self.shared, self.timeout)
+        self.got = self.handle is not None
+        return self.got
+
+    def release(self):
+        assert self.got
+        if self.got:
+            self.got = False
+            handle, self.handle = self.handle, None
+            if self.ack:
+                self.session.release(*handle)
+            else:
+                spawn(self.session.release, *handle)
+
+    def locked(self):
+        return self.session.rpc_lock._is_locked_execute(self.name)
+    is_locked = locked
+
+    def idle(self):
+        assert self.got
+        if not self.session.alive or self.session.id != self.handle[0]:
+            raise AZRPCTimeout('Session closed while idling')
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        if self.got:
+            self.release()
+
+
+# Client local lock helper classes
+
+class LocalEntry(object):
+    def __init__(self):
+        self.sema = Semaphore()
+        self.users = 0
+        self.waiters = 0
+        self.handoffs = 0
+        self.remote = None
+
+
+class LocalLocks(object):
+    """Coalesces the locks of all greenlets of this process. Only the first
+    greenlet acquires the name from the server, later ones wait on a local
+    semaphore and get the remote lock handed over on release. After
+    `max_handoffs` local handovers the remote lock is released anyway so other
+    processes get their turn.
+    """
+    def __init__(self, rpc_lock, max_handoffs=16):
+        self.rpc_lock = rpc_lock
+        self.max_handoffs = max_handoffs
+        self.entries = dict()
+
+    def _enter(self, name):
+        if name not in self.entries:
+            entry = LocalEntry()
+            self.entries[name] = entry
+        else:
+            entry = self.entries[name]
+        entry.users += 1
+        return entry
+
+    def _leave(self, name, entry):
+        entry.users -= 1
+        if entry.users == 0:
+            del self.entries[name]
+
+    @contextmanager
+    def get_lock(self, name, try_=False, timeout=None):
+        lock = LocalLock(self, name, try_, timeout)
+        with lock as got_lock:
+            yield got_lock
+
+
+class LocalLock(object):
+    entry = None
+    got = False
+
+    def __init__(self, local_locks, name, try_=False, timeout=None):
+        self.local_locks = local_locks
+        self.name = name
+        self.try_ = try_
+        self.timeout = timeout
+
+    def acquire(self):
+        entry = self.local_locks._enter(self.name)
+        if self.try_:
+            got = entry.sema.acquire(blocking=False)
+        else:
+            entry.waiters += 1
+            try:
+                got = entry.sema.acquire(timeout=self.timeout)
+            finally:
+                entry.waiters -= 1
+        if got and entry.remote is None:
+            remote = Lock(self.local_locks.rpc_lock, self.name, self.try_, timeout=self.timeout)
+            try:
+                got = remote.acquire()
+            except:
+                entry.sema.release()
+                self.local_locks._leave(self.name, entry)
+                raise
+            if got:
+                entry.remote = remote
+                entry.handoffs = 0
+            else:
+                entry.sema.release()
+        if not got:
+            self.local_locks._leave(self.name, entry)
+            return False
+        self.entry = entry
+        self.got = True
+        return True
+
+    def release(self):
+        assert self.got
+        if self.got:
+            self.got = False
+            entry, self.entry = self.entry, None
+            try:
+                entry.handoffs += 1
+                if entry.waiters == 0 or entry.handoffs >= self.local_locks.max_handoffs:
+                    remote, entry.remote = entry.remote, None
+                    remote.release()
+            finally:
+                entry.sema.release()
+                self.local_locks._leave(self.name, entry)
+
+    def locked(self):
+        return self.local_locks.rpc_lock._is_locked_execute(self.name)
+    is_locked = locked
+
+    def idle(self):
+        assert self.got
+        self.entry.remote.idle()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        if self.got:
+            self.release()
@@ -0,0 +1,276 @@
+import logging
+
+from time import time
+from gevent.lock import Semaphore
+
+from .sync import RPCSync
+from .wheel import TimerWheel
+
+logger = logging.getLogger(__name__)
+
+
+class Bucket(object):
+    """Token bucket of a key. Full buckets are dropped, a missing bucket is a
+    full one, so only keys which were used lately take memory.
+    """
+    __slots__ = ('id', 'tokens', 'stamp', 'expires', 'wheel_slot')
+
+    def __init__(self, id, tokens, stamp):
+        self.id = id
+        self.tokens = tokens
+        self.stamp = stamp
+        self.expires = None
+        self.wheel_slot = None
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'tokens': self.tokens,
+            'stamp': self.stamp,
+        }
+
+
+class RateLimiter(RPCSync):
+    """Token buckets per key which refill with `rate` tokens per second up to
+    `capacity` tokens, which defaults to `rate`. `set_limit` overrides both
+    for single keys. Bucket states are pushed to followers, keyword arguments
+    like `coalesce` or `prefixes` are passed to `RPCSync`. `shard` suffixes
+    the RPC names, so the shards of a `ShardedRateLimiter` don't share them.
+    """
+    __sync_members__ = ('id', 'tokens', 'stamp', 'rate', 'capacity')
+
+    def __init__(self, rpc, name, instance_id=None, target=None, rate=10.0, capacity=None, shard=None, **kwargs):
+        sync_name = '%s.%s' % (__name__, name) if shard is None else '%s.%s/%s' % (__name__, name, shard)
+        super(RateLimiter, self).__init__(rpc, sync_name, instance_id, target, **kwargs)
+
+        assert rate > 0, rate
+        self.rate = float(rate)
+        self.capacity = float(rate if capacity is None else capacity)
+
+        self.stats = {
+            'requests': 0,
+            'consumed': 0,
+            'rejected': 0,
+            'refunded': 0,
+            'expired': 0,
+        }
+
+        self.objects = dict()
+        self.limits = dict()
+        self.wheel = TimerWheel(self._expire_bucket) if self.is_master else None
+
+        self._consume = rpc.add(self._consume, '%s.consume' % self.name)
+        self._consume_execute = lambda *args: self._consume.execute(target, *args)
+
+        self._refund = rpc.add(self._refund, '%s.refund' % self.name)
+        self._refund_execute = lambda *args: self._refund.execute(target, *args)
+
+        self._set_limit = rpc.add(self._set_limit, '%s.set_limit' % self.name)
+        self._set_limit_execute = lambda *args: self._set_limit.execute(target, *args)
+
+        self.start()
+
+    def stop(self):
+        super(RateLimiter, self).stop()
+        if self.wheel is not None:
+            self.wheel.stop()
+
+    def get_server_counters(self):
+        assert self.is_master
+        counters = dict(self.stats)
+        counters.update(
+            buckets=len(self.objects),
+            limits=len(self.limits))
+        return counters
+
+    @staticmethod
+    def format_server_stats(counters):
+        return (
+            '{buckets} buckets, {limits} limits, '
+            '{requests} requests, {consumed} consumed, {rejected} rejected, {refunded} refunded, '
+            '{expired} expired'.format(**counters))
+
+    def get_server_stats(self):
+        return self.format_server_stats(self.get_server_counters())
+
+    def get_limit(self, key):
+        return self.limits.get(key) or (self.rate, self.capacity)
+
+    def _take(self, key, n, partial, now):
+        rate, capacity = self.get_limit(key)
+        bucket = self.objects.get(key)
+        if bucket is None:
+            tokens = capacity
+        else:
+            tokens = min(capacity, bucket.tokens + (now - bucket.stamp) * rate)
+        if tokens >= n:
+            granted = n
+        elif partial:
+            granted = max(int(tokens), 0)
+        else:
+            granted = 0
+        if not granted:
+            self.stats['rejected'] += 1
+            return 0
+        self._set_tokens(key, bucket, tokens - granted, now, rate, capacity)
+        self.stats['consumed'] += granted
+        return granted
+
+    def _set_tokens(self, key, bucket, tokens, now, rate, capacity):
+        if bucket is None:
+            bucket = Bucket(key, tokens, now)
+            self.objects[key] = bucket
+            bucket.expires = now + (capacity - tokens) / rate
+            self.wheel.add(bucket)
+        else:
+            bucket.tokens = tokens
+            bucket.stamp = now
+            bucket.expires = now + (capacity - tokens) / rate
+        self.push(bucket)
+
+    def _consume(self, requests):
+        """Takes tokens for a list of `(key, n, partial)` tuples and returns the
+        granted numbers. Without `partial` a request gets all or nothing.
+        """
+        assert self.is_master
+        now = time()
+        self.stats['requests'] += 1
+        return [self._take(key, n, partial, now) for key, n, partial in requests]
+
+    def _refund(self, requests):
+        """Gives unused tokens of a list of `(key, n)` tuples back."""
+        assert self.is_master
+        now = time()
+        for key, n in requests:
+            bucket = self.objects.get(key)
+            if bucket is None:
+                continue
+            rate, capacity = self.get_limit(key)
+            tokens = min(capacity, bucket.tokens + (now - bucket.stamp) * rate + n)
+            self._set_tokens(key, bucket, tokens, now, rate, capacity)
+            self.stats['refunded'] += n
+
+    def _set_limit(self, key, rate, capacity=None):
+        assert self.is_master
+        now = time()
+        old_rate, old_capacity = self.get_limit(key)
+        if rate is None:
+            self.limits.pop(key, None)
+        else:
+            assert rate > 0, rate
+            self.limits[key] = (float(rate), float(rate if capacity is None else capacity))
+        bucket = self.objects.get(key)
+        if bucket is not None:
+            # Refilled with the old limit up to now, the bucket expires when
+            # it is full with the new one.
+            tokens = min(old_capacity, bucket.tokens + (now - bucket.stamp) * old_rate)
+            rate, capacity = self.get_limit(key)
+            self._set_tokens(key, bucket, min(capacity, tokens), now, rate, capacity)
+
+    def _expire_bucket(self, bucket):
+        if self.objects.get(bucket.id) is not bucket:
+            return
+        del self.objects[bucket.id]
+        self.stats['expired'] += 1
+        self.add('del', bucket.id)
+
+    def serialize_bucket(self, bucket):
+        data = bucket.serialize()
+        if bucket.id in self.limits:
+            data['rate'], data['capacity'] = self.limits[bucket.id]
+        return data
+
+    def _push(self, bucket):
+        # Buckets don't know their limits, so they are serialized here.
+        if self.objects.get(bucket.id) is bucket:
+            self.add('update', self.serialize_bucket(bucket))
+
+    def get_all_ids(self):
+        assert not self.is_master
+        return self.objects.keys()
+
+    def on_not_found_ids(self, ids):
+        assert not self.is_master
+        for id in ids:
+            self.on_delete(id)
+
+    def on_update(self, data):
+        assert not self.is_master
+        self.objects[data['id']] = data
+
+    def on_patch(self, data):
+        assert not self.is_master
+        self.objects.setdefault(data['id'], {}).update(data)
+
+    def on_delete(self, id):
+        assert not self.is_master
+        self.objects.pop(id, None)
+
+    # Client code
+
+    def consume(self, key, n=1):
+        """Returns whether `n` tokens of `key` were available."""
+        assert not self.is_master
+        return self._consume_execute([(key, n, False)])[0] == n
+
+    def consume_many(self, requests):
+        """Takes tokens for many `(key, n)` tuples in one request and returns a
+        list of whether each request got its tokens.
+        """
+        assert not self.is_master
+        requests = [(key, n, False) for key, n in requests]
+        return [granted == n for granted, (key, n, _) in zip(self._consume_execute(requests), requests)]
+
+    def set_limit(self, key, rate, capacity=None):
+        """Overrides the limit of `key`, `rate` `None` restores the default."""
+        assert not self.is_master
+        self._set_limit_execute(key, rate, capacity)
+
+    def available(self, key):
+        """Estimates the tokens of `key` from the pushed state."""
+        assert not self.is_master
+        data = self.objects.get(key)
+        if data is None:
+            return self.capacity
+        rate = data.get('rate', self.rate)
+        capacity = data.get('capacity', self.capacity)
+        return min(capacity, data['tokens'] + (time() - data['stamp']) * rate)
+
+    def get_tokens(self, key, block=10):
+        return LeasedTokens(self, key, block)
+
+
+class LeasedTokens(object):
+    """Takes up to `block` tokens of a key at once and hands them out locally,
+    so most `consume` calls don't need a round trip. `close` gives the unused
+    tokens back.
+    """
+    def __init__(self, limiter, key, block=10):
+        self.limiter = limiter
+        self.key = key
+        self.block = block
+        self.tokens = 0
+        self.lock = Semaphore()
+
+    def consume(self, n=1):
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        with self.lock:
+            if self.tokens < n:
+                self.tokens += self.limiter._consume_execute([(self.key, max(self.block, n) - self.tokens, True)])[0]
+            if self.tokens < n:
+                return False
+            self.tokens -= n
+            return True
+
+    def close(self):
+        tokens, self.tokens = self.tokens, 0
+        if tokens:
+            self.limiter._refund_execute([(self.key, tokens)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,282 @@
+import logging
+
+from bisect import bisect, insort
+from contextlib import contextmanager
+from hashlib import md5
+from socket import gethostname
+
+from azrpc import AZRPC
+
+from .lock import RPCLock, Locks
+from .slotkeeper import SlotKeeper
+from .ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing(object):
+    """Consistent hash ring with `replicas` virtual nodes per node and weight
+    unit. Adding or removing a node only moves the keys of that node.
+    """
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self.keys = []
+        self.ring = dict()
+        self.weights = dict()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        # Ids aren't restricted to strings, others hash like their `str`.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        elif not isinstance(key, str):
+            key = str(key)
+        return int(md5(key).hexdigest()[:16], 16)
+
+    def add(self, node, weight=1):
+        """Adds a node which gets a share of the keys relative to `weight`."""
+        assert node not in self.weights, node
+        self.weights[node] = weight
+        for i in xrange(int(self.replicas * weight)):
+            h = self._hash('%s#%d' % (node, i))
+            if h not in self.ring:
+                insort(self.keys, h)
+            self.ring[h] = node
+
+    def remove(self, node):
+        weight = self.weights.pop(node)
+        for i in xrange(int(self.replicas * weight)):
+            h = self._hash('%s#%d' % (node, i))
+            if self.ring.get(h) == node:
+                del self.ring[h]
+                self.keys.remove(h)
+
+    def get(self, key):
+        if not self.keys:
+            raise KeyError('Empty hash ring')
+        i = bisect(self.keys, self._hash(key)) % len(self.keys)
+        return self.ring[self.keys[i]]
+
+    def __len__(self):
+        return len(self.weights)
+
+
+class Partitions(object):
+    """Publishes the worker ports of a server started with `--workers` so
+    clients can connect to the workers directly, see `add_workers`. The keys
+    start with `prefix`, which has to differ between servers and defaults to
+    the host name.
+    """
+    def __init__(self, rpc, ports=None, target=None, prefix=None):
+        self.ports = ports
+        self.prefix = gethostname() if prefix is None else prefix
+        self._get_partitions = rpc.add(self._get_partitions, '%s.partitions' % __name__)
+        self._get_partitions_execute = lambda *args: self._get_partitions.execute(target, *args)
+
+    def get_key(self, i):
+        return '%s/worker-%d' % (self.prefix, i)
+
+    def _get_partitions(self):
+        return [(self.get_key(i), port) for i, port in enumerate(self.ports)]
+
+    def get_partitions(self):
+        """Returns a list of `(key, port)` tuples."""
+        return self._get_partitions_execute()
+
+
+class Sharded(object):
+    """Routes names to one instance per target through a `HashRing`. Every
+    instance is created with its key as shard name, servers have to serve
+    them with the same one, like with `--shard` or `--workers`.
+    """
+    def __init__(self, rpc, targets, replicas=128):
+        self.rpc = rpc
+        self.shards = dict()
+        self.ring = HashRing(replicas=replicas)
+        for target in targets:
+            self.add_target(target)
+
+    def create(self, rpc, target, shard):
+        raise NotImplementedError()
+
+    def add_target(self, target, rpc=None, key=None, weight=1):
+        """Adds a shard. Its place on the ring is defined by `key` which
+        defaults to the target and has to be the same on all clients.
+        """
+        if key is None:
+            key = '%s' % (target,)
+        assert key not in self.shards, key
+        self.shards[key] = self.create(rpc or self.rpc, target, key)
+        self.ring.add(key, weight)
+
+    def remove_target(self, key):
+        self.ring.remove(key)
+        return self.shards.pop(key)
+
+    def get_shard(self, name):
+        return self.shards[self.ring.get(name)]
+
+    def group(self, names):
+        """Returns `(key, names)` tuples in key order."""
+        groups = dict()
+        for name in names:
+            groups.setdefault(self.ring.get(name), []).append(name)
+        return sorted(groups.items())
+
+
+class ShardedRPCLock(Sharded):
+    """Client side `RPCLock` which spreads the names over many servers."""
+    def __init__(self, rpc, name, targets=(), replicas=128):
+        self.name = name
+        super(ShardedRPCLock, self).__init__(rpc, targets, replicas)
+
+    def create(self, rpc, target, shard):
+        return RPCLock(rpc, self.name, target, shard)
+
+    def get_lock(self, name, *args, **kwargs):
+        return self.get_shard(name).get_lock(name, *args, **kwargs)
+
+    @contextmanager
+    def get_locks(self, names, try_=False, shared=False, timeout=None, ack=True):
+        """Acquires all names like `RPCLock.get_locks`, shard by shard in key
+        order so overlapping requests can't deadlock each other.
+        """
+        acquired = []
+        try:
+            got = True
+            for key, shard_names in self.group(set(names)):
+                lock = Locks(self.shards[key], shard_names, try_, shared, timeout, ack)
+                if not lock.acquire():
+                    got = False
+                    break
+                acquired.append(lock)
+            if not got:
+                while acquired:
+                    acquired.pop().release()
+            yield got
+        finally:
+            while acquired:
+                acquired.pop().release()
+
+    def get_lease(self, name, *args, **kwargs):
+        return self.get_shard(name).get_lease(name, *args, **kwargs)
+
+    def renew_leases(self, leases):
+        groups = dict()
+        for lease in leases:
+            groups.setdefault(lease.rpc_lock, []).append(lease)
+        expired = []
+        for rpc_lock, shard_leases in groups.iteritems():
+            expired.extend(rpc_lock.renew_leases(shard_leases))
+        return expired
+
+    def watch_locks(self, callback, names=None, prefixes=None, instance_id=None):
+        """Watches all shards, returns the list of started `LockWatch`es."""
+        return [shard.watch_locks(callback, names, prefixes, instance_id) for shard in self.shards.values()]
+
+    def locked(self, name):
+        return self.get_shard(name).locked(name)
+    is_locked = locked
+
+    def lock_states(self, names):
+        states = dict()
+        for key, shard_names in self.group(names):
+            states.update(self.shards[key].lock_states(shard_names))
+        return states
+
+    def locked_many(self, names):
+        return dict((name, state['locked']) for name, state in self.lock_states(names).iteritems())
+    are_locked = locked_many
+
+
+class ShardedSlotKeeper(Sharded):
+    """Client side `SlotKeeper` which spreads the ids over many servers."""
+    def __init__(self, rpc, name, instance_id, targets=(), replicas=128):
+        self.name = name
+        self.instance_id = instance_id
+        super(ShardedSlotKeeper, self).__init__(rpc, targets, replicas)
+
+    def create(self, rpc, target, shard):
+        return SlotKeeper(rpc, self.name, self.instance_id, target, shard=shard)
+
+    def remove_target(self, key):
+        shard = super(ShardedSlotKeeper, self).remove_target(key)
+        shard.stop()
+        return shard
+
+    def stop(self):
+        for shard in self.shards.values():
+            shard.stop()
+
+    def wait_live(self, timeout=None):
+        for shard in self.shards.values():
+            shard.wait_live(timeout)
+
+    def get_slotkeeper(self, id, max_slots, max_units=0):
+        return self.get_shard(id).get_slotkeeper(id, max_slots, max_units)
+    get = get_slotkeeper
+
+
+class ShardedRateLimiter(Sharded):
+    """Client side `RateLimiter` which spreads the keys over many servers.
+    The servers need the same `rate` and `capacity`, every key is limited by
+    its own server only.
+    """
+    def __init__(self, rpc, name, instance_id, targets=(), replicas=128, **kwargs):
+        self.name = name
+        self.instance_id = instance_id
+        self.kwargs = kwargs
+        super(ShardedRateLimiter, self).__init__(rpc, targets, replicas)
+
+    def create(self, rpc, target, shard):
+        return RateLimiter(rpc, self.name, self.instance_id, target, shard=shard, **self.kwargs)
+
+    def remove_target(self, key):
+        shard = super(ShardedRateLimiter, self).remove_target(key)
+        shard.stop()
+        return shard
+
+    def stop(self):
+        for shard in self.shards.values():
+            shard.stop()
+
+    def wait_live(self, timeout=None):
+        for shard in self.shards.values():
+            shard.wait_live(timeout)
+
+    def consume(self, key, n=1):
+        return self.get_shard(key).consume(key, n)
+
+    def consume_many(self, requests):
+        """Sends one request per server, the results are in `requests` order."""
+        requests = list(requests)
+        groups = dict()
+        for i, (key, n) in enumerate(requests):
+            groups.setdefault(self.ring.get(key), []).append(i)
+        results = [None] * len(requests)
+        for shard_key, indexes in sorted(groups.items()):
+            granted = self.shards[shard_key].consume_many([requests[i] for i in indexes])
+            for i, got in zip(indexes, granted):
+                results[i] = got
+        return results
+
+    def set_limit(self, key, rate, capacity=None):
+        self.get_shard(key).set_limit(key, rate, capacity)
+
+    def available(self, key):
+        return self.get_shard(key).available(key)
+
+    def get_tokens(self, key, block=10):
+        return self.get_shard(key).get_tokens(key, block)
+
+
+def add_workers(sharded, rpc_name, target=None, heartbeat_timeout=10):
+    """Adds the workers of a server started with `--workers` to a sharded
+    client. `target` is the server whose front port `sharded.rpc` connects to.
+    """
+    for key, port in Partitions(sharded.rpc, target=target).get_partitions():
+        rpc = AZRPC(rpc_name, port, heartbeat_timeout=heartbeat_timeout)
+        sharded.add_target(target, rpc, key)
+    return sharded
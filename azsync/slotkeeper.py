@@ -1,31 +1,154 @@
 import logging
 
-from gevent import GreenletExit
+from time import time
+from itertools import count
+from uuid import uuid4
+from contextlib import contextmanager
+from gevent import GreenletExit, Timeout, spawn, spawn_later
 from gevent.lock import Semaphore
 from gevent.event import Event
+from collections import deque
 from weakref import WeakValueDictionary, WeakSet
 
 from azrpc import AZRPCTimeout
 
-from .sync import RPCSync, RPCPuller
+from .sync import RPCSync, RPCSyncError, RPCPusher, RPCPuller
+from .wheel import TimerWheel
 
 logger = logging.getLogger(__name__)
 
 
-class Master(object):
-    def __init__(self, id, max_slots):
+class UnitTicket(object):
+    def __init__(self, units):
+        self.units = units
+        self.granted = False
+        self.bypassed = 0
+        self.event = Event()
+
+
+class WeightedSemaphore(object):
+    """Semaphore of `value` units, 0 meaning unlimited. Waiters are granted
+    first-fit in arrival order, so a large request doesn't hold back smaller
+    ones which fit. To not starve large requests, the oldest waiter is passed
+    at most `max_bypass` times, after that everyone queues up behind it.
+    `on_change` is called whenever the counters change.
+    """
+    def __init__(self, name=None, value=0, on_change=None, max_bypass=10):
+        self.name = name
+        self.value = value
+        self.on_change = on_change
+        self.max_bypass = max_bypass
+        self.used = 0
+        self.queued = 0
+        self.queue = deque()
+
+    @property
+    def waiters(self):
+        return len(self.queue)
+
+    def _fits(self, units):
+        return not self.value or self.used + units <= self.value
+
+    def _bypass(self, queue):
+        """Returns whether a request may pass the waiters in `queue`."""
+        if not queue:
+            return True
+        if queue[0].bypassed >= self.max_bypass:
+            return False
+        queue[0].bypassed += 1
+        return True
+
+    def _wake(self):
+        if not self.queue or (self.value and self.used >= self.value):
+            return False
+        granted = False
+        queue = deque()
+        for ticket in self.queue:
+            if self._fits(ticket.units) and self._bypass(queue):
+                self.used += ticket.units
+                self.queued -= ticket.units
+                ticket.granted = True
+                ticket.event.set()
+                granted = True
+            else:
+                queue.append(ticket)
+        self.queue = queue
+        return granted
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def acquire(self, units=1, blocking=True, timeout=None):
+        """Returns `True` when the units were acquired and `False` when it
+        wasn't possible without blocking, within `timeout` seconds or at all.
+        """
+        assert units > 0, units
+        if self._fits(units) and self._bypass(self.queue):
+            self.used += units
+            self._changed()
+            return True
+        if not blocking or (self.value and units > self.value):
+            return False
+        ticket = UnitTicket(units)
+        self.queue.append(ticket)
+        self.queued += units
+        self._changed()
+        try:
+            ticket.event.wait(timeout)
+        except:
+            self._cancel(ticket)
+            raise
+        if not ticket.granted:
+            self._cancel(ticket)
+            return False
+        return True
+
+    def _cancel(self, ticket):
+        if ticket.granted:
+            self.release(ticket.units)
+        else:
+            self.queue.remove(ticket)
+            self.queued -= ticket.units
+            self._changed()
+
+    def release(self, units=1):
+        assert 0 < units <= self.used, units
+        self.used -= units
+        self._wake()
+        self._changed()
+
+
+class Master(RPCPusher):
+    __rpc_members__ = ('id', 'max_slots', 'slots', 'workers', 'max_units', 'units', 'unit_waiters', 'version')
+
+    def __init__(self, id, max_slots, on_units_change=None):
         self.id = id
         self.max_slots = max_slots
         self.lock = Semaphore()
         self.slots = WeakValueDictionary()
+        self.workers = 0
+        self.units = WeightedSemaphore(id, on_change=on_units_change)
+        self.version = 0
+        self.deleted = False
+        self.expires = None
+        self.wheel_slot = None
 
     def serialize(self):
         return {
             'id': self.id,
             'max_slots': self.max_slots,
             'slots': len(self.slots),
-            'workers': sum(len(slot.workers) for slot in self.slots.values())
+            'workers': self.workers,
+            'max_units': self.units.value,
+            'units': self.units.used,
+            'unit_waiters': self.units.queued,
+            'version': self.version,
         }
+    rpc_state = serialize
+
+    def idle(self):
+        return not self.slots and not self.units.used and not self.units.queue
 
 
 class MasterSlot(object):
@@ -33,13 +156,34 @@ class MasterSlot(object):
         self.workers = WeakSet()
 
 
-class Waiter(object):
-    pass
+class MasterWorker(object):
+    def __init__(self, master, slot_id, slot):
+        self.master = master
+        self.slot_id = slot_id
+        self.slot = slot
+        self.released = False
+
+
+class MasterUnits(object):
+    def __init__(self, master, units):
+        self.master = master
+        self.units = units
 
 
 class SlotKeeper(RPCSync):
-    def __init__(self, rpc, name, instance_id=None, target=None):
-        super(SlotKeeper, self).__init__(rpc, __name__, instance_id, target)
+    """Keyword arguments like `coalesce`, `delta` or `relay_rpc` are passed to
+    `RPCSync`. The master deletes ids without slots and units after
+    `idle_timeout` seconds. `shard` suffixes the RPC names, so the shards of
+    a `ShardedSlotKeeper` don't share them.
+
+    Besides slots every id has a `WeightedSemaphore` of `max_units` units
+    which are acquired and released by weight through `Keeper.get_units`.
+    """
+    __sync_members__ = Master.__rpc_members__
+
+    def __init__(self, rpc, name, instance_id=None, target=None, idle_timeout=60, shard=None, **kwargs):
+        sync_name = __name__ if shard is None else '%s/%s' % (__name__, shard)
+        super(SlotKeeper, self).__init__(rpc, sync_name, instance_id, target, **kwargs)
 
         self.stats = {
             'requests': 0,
@@ -51,72 +195,127 @@ class SlotKeeper(RPCSync):
             'released': 0,
             'timeout': 0,
             'unexpected': 0,
+            'expired': 0,
+            'picked': 0,
+            'unit_requests': 0,
+            'units_acquired': 0,
+            'units_failed': 0,
         }
 
         self.objects = dict()
+        # Keepers of deleted ids, kept while clients use them so they get the
+        # updates when the id comes back.
+        self.deleted = WeakValueDictionary()
+        self.workers = WeakValueDictionary()
+        self.unit_holders = WeakValueDictionary()
+        self.total_slots = 0
+        self.total_workers = 0
+        self.total_units = 0
+        self.idle_timeout = idle_timeout
+        self.idle_wheel = TimerWheel(self._expire_master) if self.is_master and idle_timeout else None
         self.lock = Semaphore()
+        # Versions only grow, even over restarts of the master, so followers
+        # can always drop states older than the one they have.
+        self.versions = count(int(time() * 1000000))
 
         self._acquire_slot = rpc.add(self._acquire_slot, '%s.acquire' % self.name)
         self._acquire_slot_stream_sync = lambda *args: self._acquire_slot.stream_sync(target, *args)
 
+        self._release_slot = rpc.add(self._release_slot, '%s.release' % self.name)
+        self._release_slot_execute = lambda *args: self._release_slot.execute(target, *args)
+
+        self._acquire_units = rpc.add(self._acquire_units, '%s.acquire_units' % self.name)
+        self._acquire_units_stream_sync = lambda *args: self._acquire_units.stream_sync(target, *args)
+
+        self._release_units = rpc.add(self._release_units, '%s.release_units' % self.name)
+        self._release_units_execute = lambda *args: self._release_units.execute(target, *args)
+
         self.start()
 
-    def get_server_stats(self):
+    def stop(self):
+        super(SlotKeeper, self).stop()
+        if self.idle_wheel is not None:
+            self.idle_wheel.stop()
+
+    def get_server_counters(self):
         assert self.is_master
-        slots = 0
-        workers = 0
-        for obj in self.objects.values():
-            slots += len(obj.slots)
-            for slot in obj.slots.values():
-                workers += len(slot.workers)
-        stats = (
-            '{objects} objects, {slots} slots, {workers} workers, '
+        sync_stats = self.get_sync_stats()
+        counters = dict(self.stats)
+        counters.update(
+            objects=len(self.objects),
+            slots=self.total_slots,
+            workers=self.total_workers,
+            units=self.total_units,
+            followers=len(sync_stats),
+            queued=sum(stats['depth'] for stats in sync_stats),
+            lag=sum(stats['lag'] for stats in sync_stats))
+        return counters
+
+    @staticmethod
+    def format_server_stats(counters):
+        return (
+            '{objects} objects, {slots} slots, {workers} workers, {units} units, '
             '{requests} requests, '
             '{created_slots} created slots, {created_workers} created workers, {full} full, {empty} empty, '
             '{acquired} acquired, {released} released, '
-            '{timeout} timeout, {unexpected} unexpected'.format(
-                objects=len(self.objects),
-                slots=slots,
-                workers=workers,
-                **self.stats))
-        return stats
-
-    def _acquire_slot(self, id, max_slots, slot_id):
+            '{timeout} timeout, {unexpected} unexpected, {expired} expired, {picked} picked, '
+            '{unit_requests} unit requests, {units_acquired} units acquired, {units_failed} units failed, '
+            '{followers} followers, {queued} queued, {lag} lag'.format(**counters))
+
+    def get_server_stats(self):
+        stats = self.format_server_stats(self.get_server_counters())
+        sync_stats = self.format_sync_stats()
+        return '%s (%s)' % (stats, sync_stats) if sync_stats else stats
+
+    def _acquire_slot(self, id, max_slots, slot_id=None, token=None, hints=None):
+        """Acquires a worker of the slot, or of the slot picked by `_pick_slot`
+        when `slot_id` is `None`. The first response is a tuple of whether the
+        slot was acquired, the current master state and the slot id. Without
+        `token`, like from older clients, all responses are plain bools.
+        """
         assert self.is_master
         self.stats['requests'] += 1
-        with self.lock:
-            if id not in self.objects:
-                master = Master(id, max_slots)
-                self.objects[id] = master
-                self.stats['created_slots'] += 1
-            else:
-                master = self.objects[id]
-
-        got = True
-        with master.lock:
-            if slot_id not in master.slots:
-                if master.max_slots > 0 and len(master.slots) >= master.max_slots:
-                    got = False
+        pick = slot_id is None
+        while True:
+            master = self._get_master(id, max_slots)
+            got = True
+            with master.lock:
+                if master.deleted:
+                    continue
+                if pick:
+                    slot_id = self._pick_slot(master, hints)
+                    self.stats['picked'] += 1
+                if slot_id not in master.slots:
+                    if master.max_slots > 0 and len(master.slots) >= master.max_slots:
+                        got = False
+                    else:
+                        self.stats['created_workers'] += 1
+                        slot = MasterSlot()
+                        master.slots[slot_id] = slot
+                        self.total_slots += 1
                 else:
-                    self.stats['created_workers'] += 1
-                    slot = MasterSlot()
-                    master.slots[slot_id] = slot
-            else:
-                slot = master.slots[slot_id]
+                    slot = master.slots[slot_id]
+            break
 
         if not got:
             self.stats['full'] += 1
-            yield False
+            yield (False, master.serialize(), slot_id) if token is not None else False
             return
 
-        worker = Waiter()
+        worker = MasterWorker(master, slot_id, slot)
         slot.workers.add(worker)
-        self.add('update', master.serialize())
+        master.workers += 1
+        self.total_workers += 1
+        master.version = next(self.versions)
+        if token is not None:
+            self.workers[token] = worker
+        self.push(master)
 
         self.stats['acquired'] += 1
         logger.debug('%s: Acquired', id)
         try:
             try:
+                yield (True, master.serialize(), slot_id) if token is not None else True
                 while True:
                     yield True
             except (GeneratorExit, GreenletExit):
@@ -129,17 +328,163 @@ class SlotKeeper(RPCSync):
                 self.stats['unexpected'] += 1
                 logger.warning('%s: Released without error', id)
         finally:
-            with master.lock:
-                slot.workers.remove(worker)
-                if len(slot.workers) == 0:
-                    del master.slots[slot_id]
-                    self.stats['empty'] += 1
-                self.add('update', master.serialize())
+            self._release_worker(worker)
+
+    @staticmethod
+    def _pick_slot(master, hints=None):
+        """Returns the least loaded slot id of `hints` which exists or fits,
+        else a new slot id when there is room or the least loaded slot id.
+        """
+        room = master.max_slots <= 0 or len(master.slots) < master.max_slots
+        best = None
+        best_load = None
+        for slot_id in hints or ():
+            slot = master.slots.get(slot_id)
+            if slot is not None:
+                load = len(slot.workers)
+            elif room:
+                load = 0
+            else:
+                continue
+            if best is None or load < best_load:
+                best = slot_id
+                best_load = load
+        if best is not None:
+            return best
+        if room:
+            return uuid4().hex
+        return min(master.slots.iteritems(), key=lambda item: len(item[1].workers))[0]
+
+    def _get_master(self, id, max_slots):
+        with self.lock:
+            if id not in self.objects:
+                master = Master(id, max_slots, self._units_changed)
+                self.objects[id] = master
+                self.stats['created_slots'] += 1
+            else:
+                master = self.objects[id]
+        return master
+
+    def _release_worker(self, worker):
+        if worker.released:
+            return False
+        worker.released = True
+        master = worker.master
+        with master.lock:
+            worker.slot.workers.remove(worker)
+            master.workers -= 1
+            self.total_workers -= 1
+            if len(worker.slot.workers) == 0:
+                del master.slots[worker.slot_id]
+                self.total_slots -= 1
+                self.stats['empty'] += 1
+            master.version = next(self.versions)
+            self._check_idle(master)
+        self.push(master)
+        return True
+
+    def _check_idle(self, master):
+        if self.idle_wheel is None or not master.idle():
+            return
+        idle = master.expires is not None
+        master.expires = time() + self.idle_timeout
+        if not idle:
+            self.idle_wheel.add(master)
 
-    def on_init_push_loop(self):
+    def _expire_master(self, master):
+        with master.lock:
+            if not master.idle():
+                master.expires = None
+                return
+            master.deleted = True
+        with self.lock:
+            if self.objects.get(master.id) is master:
+                del self.objects[master.id]
+        self.stats['expired'] += 1
+        logger.debug('%s: Expired', master.id)
+        self.add('del', master.id)
+
+    def _release_slot(self, token):
+        """Releases the worker with `token` before its stream is closed and
+        returns the new master state, or `None` when it wasn't held anymore.
+        """
         assert self.is_master
-        for obj in self.objects.values():
-            yield obj.serialize()
+        worker = self.workers.get(token)
+        if worker is None or not self._release_worker(worker):
+            return None
+        return worker.master.serialize()
+
+    def _units_changed(self, units):
+        master = self.objects.get(units.name)
+        if master is None or master.units is not units:
+            return
+        master.version = next(self.versions)
+        self._check_idle(master)
+        self.push(master)
+
+    def _acquire_units(self, id, max_slots, max_units, units, try_=False, timeout=None, token=None):
+        """Acquires `units` of the units of `id`, which has `max_units` units
+        unless they were set before. The first response is a tuple of whether
+        the units were acquired and the current master state.
+        """
+        assert self.is_master
+        self.stats['unit_requests'] += 1
+        while True:
+            master = self._get_master(id, max_slots)
+            if not master.deleted:
+                break
+        if not master.units.value:
+            master.units.value = max_units
+
+        if not master.units.acquire(units, not try_, timeout):
+            self.stats['units_failed'] += 1
+            # Failed requests don't change the units, but may have created
+            # the id.
+            self._check_idle(master)
+            yield False, master.serialize()
+            return
+
+        holder = MasterUnits(master, units)
+        if token is not None:
+            self.unit_holders[token] = holder
+        self.total_units += units
+        self.stats['units_acquired'] += units
+        logger.debug('%s: Acquired %s units', id, units)
+        try:
+            try:
+                yield True, master.serialize()
+                while True:
+                    yield True
+            except (GeneratorExit, GreenletExit):
+                logger.debug('%s: Released units', id)
+            except AZRPCTimeout:
+                self.stats['timeout'] += 1
+                logger.info('%s: Units timed out', id)
+            else:
+                self.stats['unexpected'] += 1
+                logger.warning('%s: Units released without error', id)
+        finally:
+            self._release_holder(holder)
+
+    def _release_holder(self, holder, units=None):
+        units = holder.units if units is None else min(units, holder.units)
+        if units <= 0:
+            return False
+        holder.units -= units
+        self.total_units -= units
+        holder.master.units.release(units)
+        return True
+
+    def _release_units(self, token, units=None):
+        """Releases `units` or all units of the holder with `token` before its
+        stream is closed and returns the new master state, or `None` when it
+        didn't hold units anymore.
+        """
+        assert self.is_master
+        holder = self.unit_holders.get(token)
+        if holder is None or not self._release_holder(holder, units):
+            return None
+        return holder.master.serialize()
 
     def get_all_ids(self):
         assert not self.is_master
@@ -148,32 +493,49 @@ class SlotKeeper(RPCSync):
     def on_not_found_ids(self, ids):
         assert not self.is_master
         for id in ids:
-            if id in self.objects:
-                del self.objects[id]
+            self.on_delete(id)
 
     def on_update(self, data):
         assert not self.is_master
         if data['id'] not in self.objects:
-            self.objects[data['id']] = Keeper(self, data)
-        else:
-            self.objects[data['id']]._rpc_data = data
-        self.objects[data['id']].updated.set()
+            obj = self.deleted.pop(data['id'], None)
+            if obj is None:
+                self.objects[data['id']] = Keeper(self, data)
+                self.objects[data['id']].updated.set()
+                return
+            self.objects[data['id']] = obj
+        self.objects[data['id']].apply(data, pushed=True)
+
+    def on_patch(self, data):
+        assert not self.is_master
+        if data['id'] not in self.objects:
+            raise RPCSyncError('Patch of unknown id: %s' % data['id'])
+        self.objects[data['id']].apply(data, pushed=True)
 
     def on_delete(self, id):
         assert not self.is_master
-        del self.objects[id]
+        obj = self.objects.pop(id, None)
+        if obj is not None:
+            obj.clear()
+            self.deleted[id] = obj
 
     # Client code
 
-    def get_slotkeeper(self, id, max_slots):
+    def get_slotkeeper(self, id, max_slots, max_units=0):
         assert not self.is_master
         self.wait_live()
+        if id not in self.objects and id in self.deleted:
+            self.objects[id] = self.deleted.pop(id)
         if id not in self.objects:
             data = {
                 'id': id,
                 'max_slots': max_slots,
                 'slots': 0,
-                'workers': 0
+                'workers': 0,
+                'max_units': max_units,
+                'units': 0,
+                'unit_waiters': 0,
+                'version': 0,
             }
             obj = Keeper(self, data)
             self.objects[data['id']] = obj
@@ -186,15 +548,55 @@ class SlotKeeper(RPCSync):
 
 
 class Keeper(RPCPuller):
-    __rpc_members__ = ('id', 'max_slots', 'slots', 'workers')
+    __rpc_members__ = Master.__rpc_members__
+    _rpc_pushed = None
 
     def __init__(self, sync, data):
         super(Keeper, self).__init__(data)
         self.sync = sync
         self.updated = Event()
-
-    def get_slot(self, slot_id):
-        return Slot(self, slot_id)
+        self.leased = None
+
+    def apply(self, data, pushed=False):
+        """Merges a full or partial state unless it is older than the current
+        one. `pushed` states come from the sync stream, where patches only
+        hold the members changed since the last pushed state. While the
+        current state is a newer one from a response, the last pushed state
+        is kept in `_rpc_pushed` so patches are merged into it instead.
+        """
+        if pushed and self._rpc_pushed is not None:
+            self._rpc_pushed.update(data)
+            data = self._rpc_pushed
+            if data['version'] >= self.version:
+                self._rpc_pushed = None
+        elif not pushed and self._rpc_pushed is None and data['version'] >= self.version:
+            self._rpc_pushed = dict(self._rpc_data)
+        if data['version'] >= self.version:
+            self.rpc_merge(data)
+        self.updated.set()
+        if self.leased is not None:
+            self.leased.on_update()
+
+    def clear(self):
+        """Resets the counters of a deleted id."""
+        self._rpc_pushed = None
+        self.rpc_merge({'slots': 0, 'workers': 0, 'units': 0, 'unit_waiters': 0})
+        self.updated.set()
+
+    def get_slot(self, slot_id=None, hints=None):
+        """Without `slot_id` the master picks a slot, preferring the slot ids
+        in `hints`, on every acquire. `Slot.slot_id` is the acquired one.
+        """
+        return Slot(self, slot_id, hints)
+
+    def get_units(self, units, try_=False, timeout=None):
+        return Units(self, units, try_, timeout)
+
+    def get_leased_units(self, block=10, idle_timeout=1.0):
+        """Returns the `LeasedUnits` of this follower for the id."""
+        if self.leased is None:
+            self.leased = LeasedUnits(self, block, idle_timeout)
+        return self.leased
 
     def __repr__(self):
         return 'SlotKeeper<name="%s", max=%s, slots=%s, workers=%s>' % (self.sync.name, self.max_slots, self.slots, self.workers)
@@ -203,27 +605,33 @@ class Keeper(RPCPuller):
 class Slot(object):
     gen = None
     got = False
+    slot_id = None
 
-    def __init__(self, keeper, id):
+    def __init__(self, keeper, id=None, hints=None):
         self.keeper = keeper
         self.id = id
+        self.hints = list(hints) if hints else None
+        self.token = uuid4().hex
 
     def acquire(self):
-        self.keeper.updated.clear()
-        self.gen = self.keeper.sync._acquire_slot_stream_sync(self.keeper.id, self.keeper.max_slots, self.id)
-        self.got = next(self.gen)
-        if self.got:
-            print "WAIT"
-            self.keeper.updated.wait(timeout=2)
+        self.gen = self.keeper.sync._acquire_slot_stream_sync(self.keeper.id, self.keeper.max_slots, self.id, self.token,
+                                                              self.hints)
+        self.got, data, self.slot_id = next(self.gen)
+        self.keeper.apply(data)
         return self.got
 
     def release(self):
         assert self.got
         if self.got:
-            self.keeper.updated.clear()
             self.got = False
+            try:
+                with Timeout(1):
+                    data = self.keeper.sync._release_slot_execute(self.token)
+                if data is not None:
+                    self.keeper.apply(data)
+            except Exception:
+                pass
             del self.gen
-            self.keeper.updated.wait(timeout=2)
 
     def idle(self):
         assert self.got
@@ -240,4 +648,185 @@ class Slot(object):
             self.release()
 
     def __repr__(self):
-        return 'SlotKeeperSlot<name="%s/%s", max=%s, slots=%s, workers=%s>' % (self.keeper.sync.name, self.id, self.keeper.max_slots, self.keeper.slots, self.keeper.workers)
+        return 'SlotKeeperSlot<name="%s/%s", max=%s, slots=%s, workers=%s>' % (self.keeper.sync.name, self.slot_id or self.id, self.keeper.max_slots, self.keeper.slots, self.keeper.workers)
+
+
+class Units(object):
+    """Client side holder of `units` units of a `Keeper`, which can be
+    released in parts.
+    """
+    gen = None
+    got = False
+
+    def __init__(self, keeper, units, try_=False, timeout=None):
+        self.keeper = keeper
+        self.units = units
+        self.try_ = try_
+        self.timeout = timeout
+        self.token = uuid4().hex
+
+    def acquire(self):
+        keeper = self.keeper
+        self.gen = keeper.sync._acquire_units_stream_sync(keeper.id, keeper.max_slots, keeper.max_units, self.units,
+                                                          self.try_, self.timeout, self.token)
+        self.got, data = next(self.gen)
+        keeper.apply(data)
+        return self.got
+
+    def release(self, units=None):
+        """Releases `units` or all held units."""
+        assert self.got
+        if units is not None and units < self.units:
+            data = self.keeper.sync._release_units_execute(self.token, units)
+            if data is not None:
+                self.units -= units
+                self.keeper.apply(data)
+            return
+        self.got = False
+        try:
+            with Timeout(1):
+                data = self.keeper.sync._release_units_execute(self.token)
+            if data is not None:
+                self.keeper.apply(data)
+        except Exception:
+            pass
+        del self.gen
+
+    def idle(self):
+        assert self.got
+        try:
+            next(self.gen)
+        except StopIteration:
+            raise AZRPCTimeout('Stream closed while idling')
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        if self.got:
+            self.release()
+
+    def __repr__(self):
+        return 'SlotKeeperUnits<name="%s", units=%s, max=%s, used=%s>' % (
+            self.keeper.sync.name, self.units, self.keeper.max_units, self.keeper.units)
+
+
+class LeasedUnits(object):
+    """Leases units of a `Keeper` from the master in blocks of `block` units
+    and hands them out locally without a round trip. Unused units go back
+    after `idle_timeout` seconds without acquisitions, or right away when the
+    master reports waiters, so the units move to the followers which need
+    them. The master still accounts all leased units, so `max_units` holds
+    globally.
+    """
+    def __init__(self, keeper, block=10, idle_timeout=1.0):
+        self.keeper = keeper
+        self.block = block
+        self.idle_timeout = idle_timeout
+        self.lock = Semaphore()
+        self.return_lock = Semaphore()
+        self.leases = []
+        self.leased = 0
+        self.used = 0
+        # Units being given back, they are neither used nor free anymore.
+        self.returning = 0
+        self.last_used = 0
+        self._returner = None
+
+    @property
+    def free(self):
+        return self.leased - self.used - self.returning
+
+    def acquire(self, units=1, timeout=None):
+        """Returns `True` when the units were acquired, locally if possible,
+        and `False` when the master didn't grant them within `timeout`.
+        """
+        self.last_used = time()
+        if self.free >= units:
+            self.used += units
+            return True
+        with self.lock:
+            if self.free >= units:
+                self.used += units
+                return True
+            need = units - max(self.free, 0)
+            lease = Units(self.keeper, max(self.block, need), try_=True)
+            if lease.acquire():
+                self._add_lease(lease, units)
+                return True
+        # Waiting for the master happens without the lock and without holding
+        # local units, those go back while other followers wait.
+        lease = Units(self.keeper, units, timeout=timeout)
+        if not lease.acquire():
+            return False
+        self._add_lease(lease, units)
+        return True
+
+    def _add_lease(self, lease, units):
+        self.leases.append(lease)
+        self.leased += lease.units
+        self.used += units
+        self._schedule_return()
+
+    def release(self, units=1):
+        assert 0 < units <= self.used, units
+        self.used -= units
+        if self.keeper.unit_waiters:
+            spawn(self._return_free)
+        else:
+            self._schedule_return()
+
+    @contextmanager
+    def hold(self, units=1, timeout=None):
+        got = self.acquire(units, timeout)
+        try:
+            yield got
+        finally:
+            if got:
+                self.release(units)
+
+    def on_update(self):
+        """Gives the free units back when other followers wait for units."""
+        if self.keeper.unit_waiters and self.free > 0:
+            spawn(self._return_free)
+
+    def _schedule_return(self):
+        if self._returner is None and self.free > 0:
+            self._returner = spawn_later(self.idle_timeout, self._return_idle)
+
+    def _return_idle(self):
+        self._returner = None
+        idle = time() - self.last_used
+        if idle < self.idle_timeout:
+            self._returner = spawn_later(self.idle_timeout - idle, self._return_idle)
+        else:
+            self._return_free()
+
+    def _return_free(self):
+        with self.return_lock:
+            while self.free > 0 and self.leases:
+                lease = self.leases[-1]
+                count = min(self.free, lease.units)
+                self.returning += count
+                try:
+                    if count == lease.units:
+                        # Closing the stream releases the units in any case.
+                        lease.release()
+                        self.leases.remove(lease)
+                        returned = count
+                    else:
+                        units = lease.units
+                        lease.release(count)
+                        returned = units - lease.units
+                except Exception as e:
+                    logger.warning('%s: Returning %s leased units failed: %s', self.keeper.id, count, e)
+                    returned = 0
+                finally:
+                    self.returning -= count
+                self.leased -= returned
+                if not returned:
+                    return
+
+    def __repr__(self):
+        return 'SlotKeeperLeasedUnits<name="%s", leased=%s, used=%s, max=%s, total=%s>' % (
+            self.keeper.sync.name, self.leased, self.used, self.keeper.max_units, self.keeper.units)
@@ -1,41 +1,174 @@
 import gevent
 import logging
-import cPickle
 
+from uuid import uuid4
+from collections import OrderedDict, deque
 from gevent.lock import Semaphore
 from gevent.event import Event
 from gevent.queue import Queue
 
 from azrpc import AZRPCTimeout
 
+from .codec import get_codec
+
 logger = logging.getLogger(__name__)
 
 
+class RPCSyncError(Exception):
+    pass
+
+
 class RPCSyncListener(object):
-    def __init__(self):
-        self.id = 1
+    """Queue of a follower stream. With `maxsize` the `policy` decides what
+    happens when the follower doesn't keep up: `disconnect` ends its stream
+    and `collapse` merges the queued changes of every object and only
+    disconnects when that doesn't help. Adding never blocks the master.
+    """
+    def __init__(self, instance_id=None, ids=None, prefixes=None, maxsize=None, policy='disconnect'):
+        assert policy in ('disconnect', 'collapse'), policy
+        self.instance_id = instance_id
+        self.maxsize = maxsize
+        self.policy = policy
         self.queue = Queue()
+        self.ids = frozenset(ids) if ids else None
+        self.prefixes = tuple(prefixes) if prefixes else None
+        self.filtered = self.ids is not None or self.prefixes is not None
+        self.initializing = False
+        self.overflowed = False
+        self.slow = False
+        self.collapsed = 0
+        self.seq = 0
+
+    def wants(self, id):
+        if self.ids is not None and id in self.ids:
+            return True
+        return self.prefixes is not None and id.startswith(self.prefixes)
+
+    def add(self, seq, action, data, id=None):
+        if self.filtered and action in ('update', 'patch', 'del') and not self.wants(id):
+            return
+        if self.overflowed:
+            return
+        self.queue.put((seq, action, data, id))
+        if self.maxsize and self.queue.qsize() > self.maxsize:
+            # The queue may grow while a snapshot is sent, the follower isn't
+            # slow then.
+            if self.policy == 'collapse' or self.initializing:
+                self._collapse()
+            if self.queue.qsize() > self.maxsize and not self.initializing:
+                self.slow = True
+                self.close()
+
+    def close(self):
+        """Ends the stream, the follower reconnects and resyncs."""
+        if self.overflowed:
+            return
+        self.overflowed = True
+        self.queue.put(None)
 
-    def add(self, action, data):
-        id = self.id
-        self.id += 1
-        self.queue.put((id, action, data))
+    def _collapse(self):
+        # An update or delete replaces all queued changes of its id, patches
+        # only apply on top of them.
+        latest = OrderedDict()
+        queued = dict()
+        count = 0
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            seq, action, data, id = item
+            if action in ('update', 'del'):
+                for key in queued.pop(id, ()):
+                    del latest[key]
+            if action in ('update', 'patch', 'del'):
+                queued.setdefault(id, []).append(seq)
+            latest[seq] = item
+            count += 1
+        for item in latest.itervalues():
+            self.queue.put_nowait(item)
+        self.collapsed += count - len(latest)
+
+    def get_stats(self, seq):
+        return {
+            'instance_id': self.instance_id,
+            'depth': self.queue.qsize(),
+            'lag': seq - self.seq,
+            'collapsed': self.collapsed,
+        }
 
 
 class RPCSync(object):
-    def __init__(self, rpc, name, instance_id=None, target=None):
+    """Pushes objects from a master to followers. Followers can restrict the
+    stream to some `ids` or id `prefixes`. With `coalesce` the master merges
+    the pushes of an object within that many seconds, `0` merges the pushes of
+    one event loop iteration.
+
+    Every change gets a sequence id and the master keeps the last `history`
+    changes. A reconnecting follower only gets the changes it missed and a
+    full snapshot only when they aren't in the history anymore. Snapshots are
+    sent in chunks of `chunk_size` objects. `max_queue` and `slow_policy` bound
+    the queue of every follower, see `RPCSyncListener`.
+
+    Updates are encoded once on the master with the `codec` backend, as
+    positional records when the class defines `__sync_members__`. Followers
+    accept the unsafe backends only when they use the same one, see
+    `RecordCodec`. With `delta` pushed objects have to be `RPCPusher`s and
+    only their changed members are sent as patches.
+
+    Followers pull from `sync_rpc` and `sync_target` when given. A follower
+    with `relay_rpc` is a relay: it serves the stream it follows on
+    `relay_rpc` with the same snapshots and sequence ids, so followers can
+    form a fan-out tree. A master created without `rpc` doesn't serve its
+    stream, the owner has to serve `_push_loop` under `get_rpc_name(name)`.
+    """
+    __sync_members__ = None
+
+    def __init__(self, rpc, name, instance_id=None, target=None, ids=None, prefixes=None, coalesce=None, history=10000,
+                 chunk_size=1000, max_queue=None, slow_policy='disconnect', codec=None, delta=False,
+                 sync_rpc=None, sync_target=None, relay_rpc=None):
         self.name = name
+        self._codec = get_codec(self.__sync_members__, codec)
         self.is_master = True if instance_id is None else False
-        rpc_name = '%s/%s/sync' % (__name__, name)
+        self.is_relay = relay_rpc is not None
+        assert not (self.is_master and self.is_relay), 'A master cannot relay'
+        rpc_name = self.get_rpc_name(name)
 
-        if self.is_master:
+        if self.is_master or self.is_relay:
             self._lock = Semaphore()
             self._listeners = set()
-            rpc.add(self._push_loop, rpc_name)
+            self._history = deque(maxlen=history)
+            self._chunk_size = chunk_size
+            self._max_queue = max_queue
+            self._slow_policy = slow_policy
+            # Copy-on-write map of the last encoded state of every object. While
+            # snapshots read it, the next change copies it instead.
+            self._states = dict()
+            self._states_readers = 0
+            push_rpc = relay_rpc if self.is_relay else rpc
+            if push_rpc is not None:
+                push_rpc.add(self._push_loop, rpc_name)
+
+        if self.is_master:
+            self._coalesce = coalesce
+            self._delta = delta
+            self._pending = OrderedDict()
+            self._flusher = None
+            self._epoch = uuid4().hex
+            self._seq = 0
         else:
             self.live_event = Event()
-            self._stream = lambda: rpc.stream(target, rpc_name, instance_id)
+            ids = list(ids) if ids else None
+            prefixes = list(prefixes) if prefixes else None
+            self._filtered = ids is not None or prefixes is not None
+            sync_rpc = rpc if sync_rpc is None else sync_rpc
+            sync_target = target if sync_target is None else sync_target
+            self._stream = lambda *args: sync_rpc.stream(sync_target, rpc_name, instance_id, ids, prefixes, *args)
             self._greenlet = None
+            self._epoch = None
+            self._seq = None
+            self._resync = False
+
+    @staticmethod
+    def get_rpc_name(name):
+        return '%s/%s/sync' % (__name__, name)
 
     def start(self):
         if not self.is_master:
@@ -54,31 +187,154 @@ class RPCSync(object):
 
     # Push functions
 
-    def add(self, action, data):
+    def add(self, action, data, state=None):
+        """Adds a change. A `patch` only has the changed members of the object
+        and needs its full `state`.
+        """
         assert self.is_master
+        if action in ('update', 'patch'):
+            id = data['id']
+            data = self._codec.encode(data)
+        else:
+            id = data
+            self._pending.pop(id, None)
         with self._lock:
+            if self._states_readers:
+                self._states = dict(self._states)
+                self._states_readers = 0
+            if action == 'update':
+                self._states[id] = data
+            elif action == 'patch':
+                # Encoded when a snapshot needs it.
+                self._states[id] = state
+            else:
+                self._states.pop(id, None)
+            self._seq += 1
+            self._history.append((self._seq, action, data, id))
             for listener in self._listeners:
-                listener.add(action, data)
+                listener.add(self._seq, action, data, id)
 
-    def _push_loop(self, instance_id):
+    def push(self, obj):
+        """Pushes an update of `obj` which needs an `id` attribute and a
+        `serialize` method.
+        """
         assert self.is_master
+        if self._coalesce is None:
+            self._push(obj)
+            return
+        self._pending[obj.id] = obj
+        if self._flusher is None:
+            self._flusher = gevent.spawn_later(self._coalesce, self._flush)
+
+    def _push(self, obj):
+        if not self._delta:
+            self.add('update', obj.serialize())
+            return
+        state, delta = obj.rpc_delta()
+        if delta is state:
+            self.add('update', state)
+        elif delta is not None:
+            self.add('patch', delta, state)
+
+    def _flush(self):
+        self._flusher = None
+        pending, self._pending = self._pending, OrderedDict()
+        for obj in pending.itervalues():
+            self._push(obj)
+
+    def get_sync_stats(self):
+        """Returns queue depth, lag and collapsed changes of every follower."""
+        assert self.is_master or self.is_relay
+        return [listener.get_stats(self._seq) for listener in self._listeners]
+
+    def format_sync_stats(self):
+        return ', '.join(
+            '{instance_id}: {depth} queued, {lag} lag, {collapsed} collapsed'.format(**stats)
+            for stats in self.get_sync_stats())
+
+    def _can_resume(self, epoch, seq):
+        if epoch != self._epoch or seq is None or seq > self._seq:
+            return False
+        return seq == self._seq or (self._history and self._history[0][0] <= seq + 1)
+
+    def _push_loop(self, instance_id, ids=None, prefixes=None, epoch=None, seq=None):
+        assert self.is_master or self.is_relay
+        if self.is_relay:
+            self.live_event.wait()
         with self._lock:
-            listener = RPCSyncListener()
-            data = list(self.on_init_push_loop())
-            listener.add('init', data)
+            listener = RPCSyncListener(instance_id, ids, prefixes, self._max_queue, self._slow_policy)
+            if self._can_resume(epoch, seq):
+                logger.debug('RPC sync push "%s" to "%s" resumed at %s', self.name, instance_id, seq)
+                listener.add(seq, 'resume', self._epoch)
+                for entry in self._history:
+                    if entry[0] > seq:
+                        listener.add(*entry)
+                snapshot = None
+            else:
+                self._states_readers += 1
+                listener.initializing = True
+                snapshot = self.on_init_push_loop(listener)
+                snapshot_states = self._states
+                snapshot_seq = self._seq
             self._listeners.add(listener)
         try:
+            if snapshot is not None:
+                try:
+                    for chunk in self._chunks(snapshot, listener):
+                        yield snapshot_seq, 'init', (self._epoch, chunk)
+                finally:
+                    if snapshot_states is self._states:
+                        self._states_readers -= 1
+                    snapshot = None
+                listener.initializing = False
+                listener.seq = snapshot_seq
+                yield snapshot_seq, 'init_done', self._epoch
             while True:
-                yield listener.queue.get()
+                item = listener.queue.get()
+                if item is None:
+                    if listener.slow:
+                        logger.warning('RPC sync push "%s" to "%s" is too slow, disconnecting', self.name, instance_id)
+                    else:
+                        logger.info('RPC sync push "%s" to "%s" closed for a resync', self.name, instance_id)
+                    return
+                if not listener.filtered and item[1] in ('update', 'patch', 'del') and item[0] != listener.seq + 1:
+                    # Collapsed changes leave gaps, which unfiltered followers
+                    # only accept when they are announced.
+                    yield item[0] - 1, 'skip', None
+                listener.seq = item[0]
+                yield item[:3]
         except AZRPCTimeout:
             logger.warning('RPC sync push "%s" to "%s" timed out', self.name, instance_id)
         except Exception as e:
             logger.exception('RPC sync push "%s" to "%s" got an error: %s', self.name, instance_id, e)
         finally:
             self._listeners.discard(listener)
+            listener.close()
 
-    def on_init_push_loop(self):
-        raise NotImplementedError()
+    def _chunks(self, snapshot, listener):
+        chunk = []
+        for id, data in snapshot:
+            if listener.filtered and not listener.wants(id):
+                continue
+            if isinstance(data, dict):
+                data = self._codec.encode(data)
+            chunk.append(data)
+            if len(chunk) >= self._chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def on_init_push_loop(self, listener):
+        """Returns an iterable of `(id, data)` tuples for the initial snapshot
+        of the new follower `listener`, `data` being a dict or an encoded
+        record. Ids the listener doesn't want are dropped later, but may be
+        skipped here already. It is called with the push lock held and
+        iterated after it is released. The default iterates the copy-on-write
+        map of all pushed states, so the snapshot is exactly the state at its
+        sequence id.
+        """
+        return self._states.iteritems()
 
     # Pull functions
 
@@ -88,41 +344,118 @@ class RPCSync(object):
             self.live_event.clear()
             try:
                 state = 'init'
-                next_id = 1
-                for id, action, data in self._stream():
-                    if next_id != id:
-                        raise RuntimeError('Out of sync: %s / %s' % (next_id, id))
-                    next_id = id + 1
-
+                not_found_ids = None
+                relay_states = dict()
+                position = (None, None) if self._resync else (self._epoch, self._seq)
+                for id, action, data in self._stream(*position):
                     if action == 'init':
                         assert state == 'init', state
-                        not_found_ids = set(self.get_all_ids())
-                        for d in data:
-                            if isinstance(d, basestring):
-                                d = cPickle.loads(d)
+                        epoch, data = data
+                        if not_found_ids is None:
+                            not_found_ids = set(self.get_all_ids())
+                        for raw in data:
+                            d = self._codec.decode(raw) if isinstance(raw, basestring) else raw
                             self.on_update(d)
                             not_found_ids.discard(d['id'])
+                            if self.is_relay:
+                                relay_states[d['id']] = raw
+                    elif action == 'init_done':
+                        assert state == 'init', state
+                        if not_found_ids is None:
+                            not_found_ids = set(self.get_all_ids())
                         if not_found_ids:
                             self.on_not_found_ids(not_found_ids)
-                        del not_found_ids
+                        not_found_ids = None
+                        if self.is_relay:
+                            self._relay_reset(data, id, relay_states)
+                        relay_states = None
+                        self._epoch = data
+                        self._seq = id
+                        self._resync = False
                         state = 'live'
                         self.live_event.set()
-                    elif action == 'update':
-                        assert state == 'live', state
-                        if isinstance(data, basestring):
-                            data = cPickle.loads(data)
-                        self.on_update(data)
-                    elif action == 'del':
+                    elif action == 'resume':
+                        assert state == 'init', state
+                        if data != self._epoch or id != self._seq:
+                            raise RPCSyncError('Invalid resume: %s / %s' % (self._seq, id))
+                        state = 'live'
+                        self.live_event.set()
+                    elif action == 'skip':
                         assert state == 'live', state
-                        self.on_delete(data)
+                        if id < self._seq:
+                            raise RPCSyncError('Invalid skip: %s / %s' % (self._seq, id))
+                        self._seq = id
                     else:
-                        raise RuntimeError('Invalid action: %s / %s' % (state, action))
+                        assert state == 'live', state
+                        # Filtered streams skip the sequence ids of other
+                        # objects.
+                        if self._filtered:
+                            in_sync = id > self._seq
+                        else:
+                            in_sync = id == self._seq + 1
+                        if not in_sync:
+                            raise RPCSyncError('Out of sync: %s / %s' % (self._seq, id))
+                        if action == 'update':
+                            d = self._codec.decode(data) if isinstance(data, basestring) else data
+                            self.on_update(d)
+                            obj_id = d['id']
+                        elif action == 'patch':
+                            d = self._codec.decode(data)
+                            self.on_patch(d)
+                            obj_id = d['id']
+                        elif action == 'del':
+                            d = None
+                            self.on_delete(data)
+                            obj_id = data
+                        else:
+                            raise RPCSyncError('Invalid action: %s / %s' % (state, action))
+                        if self.is_relay:
+                            self._relay_add(id, action, data, obj_id, d)
+                        self._seq = id
             except AZRPCTimeout:
                 logger.warning('RPC sync pull "%s" timed out', self.name)
+            except RPCSyncError as e:
+                logger.error('RPC sync pull "%s" needs a full resync: %s', self.name, e)
+                self._resync = True
             except Exception as e:
                 logger.exception('RPC sync pull "%s" got an error: %s', self.name, e)
             gevent.sleep(0.1)
 
+    # Relay functions
+
+    def _relay_reset(self, epoch, seq, states):
+        """Serves a new snapshot, followers of the old one have to resync."""
+        with self._lock:
+            self._states = states
+            self._states_readers = 0
+            self._history.clear()
+            self._epoch = epoch
+            self._seq = seq
+            for listener in self._listeners:
+                listener.close()
+
+    def _relay_add(self, seq, action, data, id, decoded):
+        """Serves a change as it was received, under its sequence id."""
+        with self._lock:
+            if self._states_readers:
+                self._states = dict(self._states)
+                self._states_readers = 0
+            if action == 'update':
+                self._states[id] = data
+            elif action == 'patch':
+                state = self._states.get(id)
+                if isinstance(state, basestring):
+                    state = self._codec.decode(state)
+                state = dict(state or ())
+                state.update(decoded)
+                self._states[id] = state
+            else:
+                self._states.pop(id, None)
+            self._seq = seq
+            self._history.append((seq, action, data, id))
+            for listener in self._listeners:
+                listener.add(seq, action, data, id)
+
     def get_all_ids(self):
         assert not self.is_master
         raise NotImplementedError()
@@ -135,22 +468,48 @@ class RPCSync(object):
         assert not self.is_master
         raise NotImplementedError()
 
+    def on_patch(self, data):
+        """Merges the changed members in `data` into the object `data['id']`."""
+        assert not self.is_master
+        raise NotImplementedError()
+
     def on_delete(self, id):
         assert not self.is_master
         raise NotImplementedError()
 
 
 class RPCPusher(object):
+    __rpc_codec__ = None
     _rpc_members_current = None
     _rpc_members_current_serialized = None
+    _rpc_members_pushed = None
+
+    def rpc_state(self):
+        data = dict()
+        for key in self.__rpc_members__:
+            data[key] = getattr(self, key)
+        return data
+
+    def rpc_delta(self):
+        """Returns the current state and the members changed since the last
+        call plus `id`. The delta is the state itself on the first call and
+        `None` when nothing changed.
+        """
+        state = self.rpc_state()
+        pushed, self._rpc_members_pushed = self._rpc_members_pushed, state
+        if pushed is None:
+            return state, state
+        delta = dict((key, value) for key, value in state.iteritems() if key not in pushed or pushed[key] != value)
+        if not delta:
+            return state, None
+        delta['id'] = state['id']
+        return state, delta
 
     def rpc_serialize(self, use_cache=False, serialized=True):
         if not use_cache or self._rpc_members_current is None:
-            data = dict()
-            for key in self.__rpc_members__:
-                data[key] = getattr(self, key)
+            data = self.rpc_state()
             self._rpc_members_current = data
-            self._rpc_members_current_serialized = cPickle.dumps(data)
+            self._rpc_members_current_serialized = get_codec(self.__rpc_members__, self.__rpc_codec__).encode(data)
         return self._rpc_members_current_serialized if serialized else self._rpc_members_current
 
 
@@ -163,6 +522,10 @@ class RPCPuller(object):
             return self._rpc_data[key]
         return getattr(super(RPCPuller, self), key)
 
+    def rpc_merge(self, data):
+        """Merges a full or partial state into the current one."""
+        self._rpc_data.update(data)
+
     def __setattr__(self, key, value):
         assert key not in self.__rpc_members__, key
         return super(RPCPuller, self).__setattr__(key, value)
@@ -5,12 +5,18 @@ import time
 import logging
 import unittest
 
+from gevent import Timeout
 from gevent.pool import Group
 
 from azrpc import AZRPC, AZRPCServer
 
-from .lock import RPCLock, Lock
-from slotkeeper import SlotKeeper
+from .sync import RPCSync, RPCSyncListener, RPCPusher
+from .codec import RecordCodec, CodecError
+from .lock import RPCLock, Lock, LockWatch
+from slotkeeper import SlotKeeper, WeightedSemaphore, Units
+from .ratelimit import RateLimiter
+from .shard import HashRing, Partitions, ShardedRPCLock, ShardedSlotKeeper, ShardedRateLimiter, add_workers
+from .__main__ import sum_counters
 
 
 rpc_name = 'azsync-test'
@@ -19,6 +25,74 @@ rpc_port = 9999
 rpc = AZRPC(rpc_name, rpc_port, heartbeat_timeout=10)
 
 
+def wait_until(predicate, timeout=2):
+    """Polls `predicate` until it is true, returns `False` on timeout."""
+    with Timeout(timeout, False):
+        while not predicate():
+            time.sleep(0.01)
+        return True
+    return False
+
+
+def wait_version(keeper, version, timeout=2):
+    """Waits until the state of a `Keeper` is at least as new as `version`,
+    like the one of another follower. Returns `False` on timeout.
+    """
+    with Timeout(timeout, False):
+        while keeper.version < version:
+            keeper.updated.clear()
+            keeper.updated.wait()
+        return True
+    return False
+
+
+class DictSync(RPCSync):
+    """Follower which keeps the pulled objects in a dict."""
+    def __init__(self, *args, **kwargs):
+        super(DictSync, self).__init__(*args, **kwargs)
+        self.objects = dict()
+        self.snapshots = 0
+        self.updates = 0
+        self.patches = 0
+
+    def get_all_ids(self):
+        self.snapshots += 1
+        return self.objects.keys()
+
+    def on_not_found_ids(self, ids):
+        for id in ids:
+            del self.objects[id]
+
+    def on_update(self, data):
+        self.updates += 1
+        self.objects[data['id']] = data
+
+    def on_patch(self, data):
+        self.patches += 1
+        self.objects[data['id']].update(data)
+
+    def on_delete(self, id):
+        self.objects.pop(id, None)
+
+
+class SyncObject(object):
+    def __init__(self, id, n=0):
+        self.id = id
+        self.n = n
+
+    def serialize(self):
+        return {'id': self.id, 'n': self.n}
+
+
+class DeltaObject(RPCPusher):
+    __rpc_members__ = ('id', 'a', 'b')
+
+    def __init__(self, id, a=0, b=0):
+        self.id = id
+        self.a = a
+        self.b = b
+
+
 class TestLock(unittest.TestCase):
     lock = RPCLock(rpc, 'test-lock')
 
@@ -89,12 +163,450 @@ class TestLock(unittest.TestCase):
                 time.sleep(1)
         self.tassert('X', 'X', lock.is_locked(), False)
 
+    def test_session(self):
+        with self.lock.get_lock('foo-session', session=True) as result:
+            self.tassert('X', 'X', result, True)
+            with self.lock.get_lock('foo-session', try_=True, session=True) as result:
+                self.tassert('X', 'X', result, False)
+            with self.lock.get_lock('bar-session', session=True) as result:
+                self.tassert('X', 'X', result, True)
+                self.tassert('X', 'X', self.lock.is_locked('bar-session'), True)
+        self.tassert('X', 'X', self.lock.is_locked('foo-session'), False)
+        self.tassert('X', 'X', self.lock.is_locked('bar-session'), False)
+        self.assertEqual(len(self.lock.sessions), 1)
+
+    def test_session_abandon(self):
+        with self.lock.get_lock('abandon-session') as result:
+            self.tassert('X', 'X', result, True)
+            group = Group()
+            group.spawn(self.lock.get_session().acquire, 'abandon-session')
+            assert wait_until(lambda: self.lock.lock_states(['abandon-session'])['abandon-session']['waiters'] == 1)
+            group.kill()
+            assert wait_until(lambda: self.lock.lock_states(['abandon-session'])['abandon-session']['waiters'] == 0)
+        self.tassert('X', 'X', self.lock.is_locked('abandon-session'), False)
+        for session in self.lock.sessions.values():
+            self.assertEqual(session.held, {})
+            self.assertEqual(session.pending, {})
+
+    def test_many_names(self):
+        with self.lock.get_lock('many-b') as result:
+            self.tassert('X', 'X', result, True)
+            with self.lock.get_locks(['many-a', 'many-b', 'many-c'], try_=True) as result:
+                self.tassert('X', 'X', result, False)
+            self.tassert('X', 'X', self.lock.is_locked('many-a'), False)
+        with self.lock.get_locks(['many-c', 'many-b', 'many-a']) as result:
+            self.tassert('X', 'X', result, True)
+            for name in ('many-a', 'many-b', 'many-c'):
+                self.tassert('X', 'X', self.lock.is_locked(name), True)
+        self.tassert('X', 'X', self.lock.is_locked('many-b'), False)
+
+    def test_release_count(self):
+        stats = self.lock.stats
+        released = stats['released']
+        # An explicit release is counted right away and not again when the
+        # stream ends.
+        lock = Lock(self.lock, 'count-a')
+        self.tassert('X', 'X', lock.acquire(), True)
+        self.assertEqual(self.lock._release_execute(lock.token), True)
+        self.assertEqual(stats['released'], released + 1)
+        lock.release()
+        time.sleep(0.1)
+        self.assertEqual(stats['released'], released + 1)
+        with Lock(self.lock, 'count-a', ack=False) as result:
+            self.tassert('X', 'X', result, True)
+        assert wait_until(lambda: stats['released'] == released + 2)
+        with self.lock.get_locks(['count-a', 'count-b']) as result:
+            self.tassert('X', 'X', result, True)
+        time.sleep(0.1)
+        self.assertEqual(stats['released'], released + 4)
+        with self.lock.get_lease('count-a', 2) as result:
+            self.tassert('X', 'X', result, True)
+        self.assertEqual(stats['released'], released + 5)
+
+    def test_lock_states(self):
+        with self.lock.get_lock('state-a'):
+            states = self.lock.lock_states(['state-a', 'state-b'])
+            self.assertEqual(states['state-a'], {'locked': True, 'holders': 1, 'readers': 0, 'writer': True, 'waiters': 0})
+            self.assertEqual(states['state-b'], {'locked': False, 'holders': 0, 'readers': 0, 'writer': False, 'waiters': 0})
+            self.assertEqual(self.lock.locked_many(['state-a', 'state-b']), {'state-a': True, 'state-b': False})
+
+    def test_shared(self):
+        with self.lock.get_lock('shared', shared=True) as result:
+            self.tassert('X', 'X', result, True)
+            with self.lock.get_lock('shared', try_=True, shared=True) as result:
+                self.tassert('X', 'X', result, True)
+                self.assertEqual(self.lock.lock_states(['shared'])['shared']['readers'], 2)
+            with self.lock.get_lock('shared', try_=True) as result:
+                self.tassert('X', 'X', result, False)
+        with self.lock.get_lock('shared', try_=True) as result:
+            self.tassert('X', 'X', result, True)
+            with self.lock.get_lock('shared', try_=True, shared=True) as result:
+                self.tassert('X', 'X', result, False)
+
+    def test_timeout(self):
+        with self.lock.get_lock('timeout') as result:
+            self.tassert('X', 'X', result, True)
+            lock = Lock(self.lock, 'timeout', timeout=1)
+            group = Group()
+            group.spawn(lock.acquire)
+            time.sleep(0.5)
+            self.assertEqual(lock.position(), 0)
+            group.join()
+            self.tassert('X', 'X', lock.got, False)
+            self.assertEqual(lock.position(), None)
+
+    def _test_local_worker(self, g):
+        with self.lock.get_lock('local', local=True) as result:
+            self.tassert(g, 'ABC', result, True)
+            self.tassert(g, 'ABC', self.lock.is_locked('local'), True)
+            time.sleep(0.2)
+
+    def test_local(self):
+        group = Group()
+        for g in 'ABC':
+            group.spawn(self._test_local_worker, g)
+        group.join()
+        self.tassert('X', 'X', self.lock.is_locked('local'), False)
+        self.assertEqual(self.lock.get_local_locks().entries, {})
+
+    def test_watch(self):
+        events = []
+        watch = self.lock.watch_locks(lambda name, state: events.append((name, state is not None)), prefixes=['watch-'])
+        watch.wait_live()
+        with self.lock.get_lock('watch-a'):
+            with self.lock.get_lock('unwatched'):
+                time.sleep(0.5)
+        time.sleep(0.5)
+        watch.stop()
+        self.assertEqual(events, [('watch-a', True), ('watch-a', False)])
+
+    def test_watch_client(self):
+        client = RPCLock(AZRPC(rpc_name, rpc_port), 'test-lock')
+        events = []
+        watch = client.watch_locks(lambda name, state: events.append((name, state is not None)), prefixes=['client-'])
+        watch.wait_live()
+        with client.get_lock('client-a'):
+            time.sleep(0.5)
+        time.sleep(0.5)
+        watch.stop()
+        self.assertEqual(events, [('client-a', True), ('client-a', False)])
+        # Only the server keeps the pushed states.
+        self.assertIs(client.watch, None)
+        self.assertIsNot(self.lock.watch, None)
+
+    def test_watch_snapshot(self):
+        events = []
+        with self.lock.get_lock('snapshot-a'):
+            watch = self.lock.watch_locks(lambda name, state: events.append((name, state is not None)), prefixes=['snapshot-'])
+            watch.wait_live()
+            self.assertEqual(events, [('snapshot-a', True)])
+        time.sleep(0.5)
+        watch.stop()
+        self.assertEqual(events, [('snapshot-a', True), ('snapshot-a', False)])
+
+    def test_watch_filtered_snapshot(self):
+        watch = LockWatch(None, 'test-filtered-snapshot', locks=self.lock.locks)
+        serialized = []
+        watch.serialize = lambda lock: serialized.append(lock.name) or LockWatch.serialize(lock)
+        with self.lock.get_lock('filtered-a'), self.lock.get_lock('other-a'):
+            snapshot = watch.on_init_push_loop(RPCSyncListener('filtered', prefixes=['filtered-']))
+            self.assertEqual(serialized, [])
+            self.assertEqual([name for name, _ in snapshot], ['filtered-a'])
+        # Locks of other names aren't serialized at all.
+        self.assertEqual(serialized, ['filtered-a'])
+
+    def test_lease(self):
+        lease = self.lock.get_lease('lease', 2)
+        with lease as result:
+            self.tassert('X', 'X', result, True)
+            other = self.lock.get_lease('lease', 2, try_=True)
+            self.tassert('X', 'X', other.acquire(), False)
+            fence = lease.fence
+            lease.renew()
+        with self.lock.get_lease('lease', 1) as result:
+            self.tassert('X', 'X', result, True)
+            lease = self.lock.get_lease('lease', 1)
+            self.tassert('X', 'X', lease.acquire(), True)
+            assert lease.fence > fence
+            self.assertEqual(lease.fence[0], fence[0])
+            self.assertEqual(self.lock.renew_leases([lease]), [])
+        time.sleep(3)
+        self.tassert('X', 'X', self.lock.is_locked('lease'), False)
+        self.assertEqual(self.lock.renew_leases([lease]), [lease])
+
+
+class TestCodec(unittest.TestCase):
+    members = ('id', 'a', 'b', 'c')
+
+    def test_records(self):
+        codec = RecordCodec(self.members)
+        for record in ({'id': 'x', 'a': 1, 'b': 2.5, 'c': None}, {'id': 'x', 'c': 3}, {'id': 'x'}, {}):
+            self.assertEqual(codec.decode(codec.encode(record)), record)
+        self.assertEqual(codec.decode(codec.encode({'id': 'x', 'd': 4})), {'id': 'x'})
+
+    def test_unsafe(self):
+        record = {'id': 'x', 'a': 1}
+        for backend in ('pickle', 'marshal'):
+            codec = RecordCodec(self.members, backend)
+            self.assertEqual(codec.decode(codec.encode(record)), record)
+            self.assertRaises(CodecError, RecordCodec(self.members, 'msgpack').decode, codec.encode(record))
+        self.assertRaises(CodecError, RecordCodec(self.members, 'marshal').decode, RecordCodec(self.members, 'pickle').encode(record))
+
+    def test_msgpack_strings(self):
+        codec = RecordCodec(self.members, 'msgpack')
+        record = codec.decode(codec.encode({'id': 'x', 'a': u'x\xe9', 'b': 'x\xc3\xa9'}))
+        self.assertEqual(record, {'id': 'x', 'a': u'x\xe9', 'b': 'x\xc3\xa9'})
+        self.assertEqual((type(record['a']), type(record['b'])), (unicode, str))
+
+
+class TestSync(unittest.TestCase):
+    def test_stalled_follower(self):
+        master = DictSync(rpc, 'test-stalled', max_queue=20)
+        stalled = AZRPC(rpc_name, rpc_port).stream(None, 'azsync.sync/test-stalled/sync', 'stalled')
+        self.assertEqual(next(stalled)[1], 'init_done')
+        follower = DictSync(AZRPC(rpc_name, rpc_port), 'test-stalled', 'follower')
+        follower.start()
+        follower.wait_live()
+        # The stalled follower gets disconnected instead of blocking the master.
+        with Timeout(5):
+            for i in xrange(100):
+                master.add('update', {'id': 'obj-%d' % (i % 10), 'n': i})
+                time.sleep(0.01)
+        assert len(list(stalled)) <= 21
+        assert wait_until(lambda: follower.objects.get('obj-9', {}).get('n') == 99)
+        self.assertEqual([stats['instance_id'] for stats in master.get_sync_stats()], ['follower'])
+        follower.stop()
+
+    def test_coalesce(self):
+        master = DictSync(rpc, 'test-coalesce', coalesce=0.2)
+        follower = DictSync(AZRPC(rpc_name, rpc_port), 'test-coalesce', 'follower')
+        follower.start()
+        follower.wait_live()
+        a = SyncObject('a')
+        b = SyncObject('b')
+        for n in xrange(10):
+            a.n = b.n = n
+            master.push(a)
+            master.push(b)
+        time.sleep(0.1)
+        self.assertEqual(follower.updates, 0)
+        assert wait_until(lambda: follower.updates == 2)
+        self.assertEqual(follower.objects, {'a': {'id': 'a', 'n': 9}, 'b': {'id': 'b', 'n': 9}})
+        # A delete drops the pending push of the object.
+        a.n = 10
+        master.push(a)
+        master.add('del', 'a')
+        time.sleep(0.3)
+        self.assertEqual(follower.objects, {'b': {'id': 'b', 'n': 9}})
+        self.assertEqual(follower.updates, 2)
+        follower.stop()
+
+    def test_chunked_snapshot(self):
+        master = DictSync(rpc, 'test-snapshot', chunk_size=10)
+        for i in xrange(35):
+            master.add('update', {'id': 'obj-%d' % i, 'n': i})
+        stream = AZRPC(rpc_name, rpc_port).stream(None, 'azsync.sync/test-snapshot/sync', 'raw')
+        items = [next(stream)]
+        self.assertEqual(items[0][:2], (35, 'init'))
+        self.assertEqual(len(items[0][2][1]), 10)
+        # Changes while the snapshot is sent don't show up in it, they follow
+        # after it.
+        master.add('update', {'id': 'obj-0', 'n': 100})
+        master.add('del', 'obj-1')
+        master.add('update', {'id': 'obj-99', 'n': 99})
+        for item in stream:
+            items.append(item)
+            if item[0] == 38:
+                break
+        stream.close()
+        self.assertEqual([item[1] for item in items], ['init'] * 4 + ['init_done', 'update', 'del', 'update'])
+        self.assertEqual([item[0] for item in items], [35] * 5 + [36, 37, 38])
+        chunks = [item[2][1] for item in items[:4]]
+        self.assertEqual(map(len, chunks), [10, 10, 10, 5])
+        snapshot = dict()
+        for chunk in chunks:
+            for record in chunk:
+                record = master._codec.decode(record)
+                snapshot[record['id']] = record['n']
+        self.assertEqual(snapshot, dict(('obj-%d' % i, i) for i in xrange(35)))
+
+    def test_patch(self):
+        master = DictSync(rpc, 'test-patch', delta=True)
+        follower = DictSync(AZRPC(rpc_name, rpc_port), 'test-patch', 'follower')
+        follower.start()
+        follower.wait_live()
+        obj = DeltaObject('obj')
+        master.push(obj)
+        obj.a = 1
+        master.push(obj)
+        master.push(obj)
+        obj.b = 2
+        master.push(obj)
+        assert wait_until(lambda: follower.objects.get('obj', {}).get('b') == 2)
+        self.assertEqual(follower.objects['obj'], {'id': 'obj', 'a': 1, 'b': 2})
+        # Unchanged pushes are dropped, changes are sent as patches.
+        self.assertEqual((follower.updates, follower.patches), (1, 2))
+        self.assertEqual(master._seq, 3)
+
+        # A new follower gets the full state in its snapshot.
+        late = DictSync(AZRPC(rpc_name, rpc_port), 'test-patch', 'late')
+        late.start()
+        late.wait_live()
+        self.assertEqual(late.objects, {'obj': {'id': 'obj', 'a': 1, 'b': 2}})
+        follower.stop()
+        late.stop()
+
+    def test_relay(self):
+        master = DictSync(rpc, 'test-relay')
+        self._update(master, 3)
+        relay_rpc = AZRPC(rpc_name, rpc_port + 10)
+        AZRPCServer(relay_rpc)
+        relay = DictSync(AZRPC(rpc_name, rpc_port), 'test-relay', 'relay', relay_rpc=relay_rpc)
+        relay.start()
+        down = DictSync(AZRPC(rpc_name, rpc_port + 10), 'test-relay', 'down')
+        down.start()
+        down.wait_live()
+        self.assertEqual(down.objects, relay.objects)
+        self.assertEqual((down._epoch, down._seq), (master._epoch, master._seq))
+
+        # Changes are re-published under the sequence ids of the master.
+        self._update(master, 3, 3)
+        master.add('del', 'obj-1')
+        assert wait_until(lambda: down._seq == master._seq)
+        self.assertEqual(down.objects, {'obj-0': {'id': 'obj-0', 'n': 3}, 'obj-2': {'id': 'obj-2', 'n': 5}})
+        self.assertEqual(down.snapshots, 1)
+        self.assertEqual([stats['instance_id'] for stats in relay.get_sync_stats()], ['down'])
+
+        # A new snapshot of the relay is passed on to its followers.
+        relay.stop()
+        relay._resync = True
+        self._update(master, 1, 6)
+        relay.start()
+        assert wait_until(lambda: down.snapshots == 2 and down.live_event.is_set())
+        self.assertEqual(down.objects['obj-0'], {'id': 'obj-0', 'n': 6})
+        self.assertEqual(down._seq, master._seq)
+        down.stop()
+        relay.stop()
+
+    def _update(self, master, count, start=0):
+        for i in xrange(start, start + count):
+            master.add('update', {'id': 'obj-%d' % (i % 3), 'n': i})
+
+    def test_resume(self):
+        master = DictSync(rpc, 'test-resume', history=5)
+        follower = DictSync(AZRPC(rpc_name, rpc_port), 'test-resume', 'follower')
+        self._update(master, 3)
+        follower.start()
+        follower.wait_live()
+        self.assertEqual(follower.snapshots, 1)
+
+        # Within the history window only the missed changes are sent.
+        follower.stop()
+        self._update(master, 4, 3)
+        follower.start()
+        assert wait_until(lambda: follower.objects['obj-0']['n'] == 6)
+        self.assertEqual(follower.snapshots, 1)
+
+        # Outside of it the follower gets a new snapshot.
+        follower.stop()
+        self._update(master, 10, 7)
+        master.add('del', 'obj-1')
+        master.add('del', 'obj-2')
+        follower.start()
+        assert wait_until(lambda: follower.objects.keys() == ['obj-0'])
+        self.assertEqual(follower.snapshots, 2)
+        self.assertEqual(follower.objects['obj-0']['n'], 15)
+        follower.stop()
+
+    def test_collapse_gaps(self):
+        master = DictSync(rpc, 'test-collapse', max_queue=3, slow_policy='collapse')
+        follower = DictSync(AZRPC(rpc_name, rpc_port), 'test-collapse', 'follower')
+        follower.start()
+        follower.wait_live()
+        for i in xrange(50):
+            master.add('update', {'id': 'obj-%d' % (i % 2), 'n': i})
+        assert wait_until(lambda: follower.objects.get('obj-1', {}).get('n') == 49)
+        self.assertEqual(follower.objects['obj-0']['n'], 48)
+        self.assertEqual(follower.snapshots, 1)
+        assert master.get_sync_stats()[0]['collapsed'] > 0
+        follower.stop()
+
+
+class TestWeightedSemaphore(unittest.TestCase):
+    def _acquire(self, sem, name, units, granted):
+        if sem.acquire(units):
+            granted.append(name)
+
+    def test_weighted(self):
+        sem = WeightedSemaphore('weighted', 10)
+        assert sem.acquire(6)
+        assert not sem.acquire(5, blocking=False)
+        assert sem.acquire(4)
+        self.assertEqual(sem.used, 10)
+        sem.release(6)
+        self.assertEqual(sem.used, 4)
+        assert not sem.acquire(7, timeout=0.1)
+        self.assertEqual((sem.used, sem.queued, sem.waiters), (4, 0, 0))
+
+    def test_over_max(self):
+        sem = WeightedSemaphore('over-max', 10)
+        with Timeout(1):
+            assert not sem.acquire(11)
+        self.assertEqual(sem.waiters, 0)
+
+    def test_wake_order(self):
+        sem = WeightedSemaphore('wake-order', 10)
+        assert sem.acquire(10)
+        granted = []
+        group = Group()
+        for name, units in (('A', 6), ('B', 5), ('C', 4)):
+            group.spawn(self._acquire, sem, name, units, granted)
+            time.sleep(0)
+        self.assertEqual(sem.queued, 15)
+        sem.release(10)
+        time.sleep(0)
+        self.assertEqual(granted, ['A', 'C'])
+        sem.release(6)
+        time.sleep(0)
+        self.assertEqual(granted, ['A', 'C', 'B'])
+        group.join()
+
+    def test_bypass(self):
+        sem = WeightedSemaphore('bypass', 10, max_bypass=2)
+        assert sem.acquire(5)
+        granted = []
+        group = Group()
+        group.spawn(self._acquire, sem, 'large', 10, granted)
+        time.sleep(0)
+        assert sem.acquire(1, blocking=False)
+        assert sem.acquire(1, blocking=False)
+        assert not sem.acquire(1, blocking=False)
+        sem.release(7)
+        group.join()
+        self.assertEqual(granted, ['large'])
+
+    def test_cancel(self):
+        sem = WeightedSemaphore('cancel', 10)
+        assert sem.acquire(10)
+        group = Group()
+        group.spawn(sem.acquire, 5)
+        time.sleep(0)
+        self.assertEqual((sem.queued, sem.waiters), (5, 1))
+        group.kill()
+        self.assertEqual((sem.queued, sem.waiters), (0, 0))
+        sem.release(10)
+        self.assertEqual(sem.used, 0)
+
 
 class TestSlotKeeper(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.master = SlotKeeper(rpc, 'foo1')
+        cls.n1 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'foo1', 'some-account-or-something')
+        cls.n2 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'foo1', 'some-account-or-something')
+
     def test(self):
-        master = SlotKeeper(rpc, 'foo1')
-        n1 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'foo1', 'some-account-or-something')
-        n2 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'foo1', 'some-account-or-something')
+        master, n1, n2 = self.master, self.n1, self.n2
 
         n1k1 = n1.get('A', 2)
         n2k1 = n2.get('A', 2)
@@ -124,6 +636,7 @@ class TestSlotKeeper(unittest.TestCase):
 
                 n2k1s1a = n2k1.get_slot('slot-1')
                 with n2k1s1a as got:
+                    wait_version(n1k1, n2k1.version)
                     assert got
                     assert n1k1.slots == 1
                     assert n1k1.workers == 3
@@ -132,6 +645,7 @@ class TestSlotKeeper(unittest.TestCase):
 
                 n2k1s2a = n2k1.get_slot('slot-2')
                 with n2k1s2a as got:
+                    wait_version(n1k1, n2k1.version)
                     assert got
                     assert n1k1.slots == 2
                     assert n1k1.workers == 3
@@ -140,6 +654,7 @@ class TestSlotKeeper(unittest.TestCase):
 
                     n2k1s3a = n2k1.get_slot('slot-3')
                     with n2k1s3a as got:
+                        wait_version(n1k1, n2k1.version)
                         assert not got
                         assert n1k1.slots == 2
                         assert n1k1.workers == 3
@@ -149,6 +664,7 @@ class TestSlotKeeper(unittest.TestCase):
                         print master.get_server_stats()
                         n2k1s2b = n2k1.get_slot('slot-2')
                         with n2k1s2b as got:
+                            wait_version(n1k1, n2k1.version)
                             assert got
                             assert n1k1.slots == 2
                             assert n1k1.workers == 4
@@ -170,8 +686,308 @@ class TestSlotKeeper(unittest.TestCase):
 
         assert n1k1.slots == 0
         assert n1k1.workers == 0
+
+        n1k3 = n1.get('C', 1)
+        n1k3s1 = n1k3.get_slot(hints=['slot-1'])
+        with n1k3s1 as got:
+            assert got
+            assert n1k3s1.slot_id == 'slot-1'
+            assert n1k3s1.id is None
+            n1k3s2 = n1k3.get_slot()
+            with n1k3s2 as got:
+                assert got
+                assert n1k3s2.slot_id == 'slot-1'
+                assert n1k3.slots == 1
+                assert n1k3.workers == 2
+                print n1k3s2
+        # The slot is picked again on the next acquire.
+        with n1k3.get_slot('slot-2'):
+            with n1k3s1 as got:
+                assert got
+                assert n1k3s1.slot_id == 'slot-2'
+
+        # Older clients don't send a token and get plain bools.
+        gen = n1._acquire_slot_stream_sync('D', 1, 'slot-1')
+        self.assertIs(next(gen), True)
+        self.assertIs(next(n1._acquire_slot_stream_sync('D', 1, 'slot-2')), False)
+        del gen
+        print master.get_server_stats()
+
+    def test_idle_expiry(self):
+        master = SlotKeeper(rpc, 'idle', idle_timeout=0.5, shard='idle')
+        n1 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'idle', 'idle-client', shard='idle')
+        k = n1.get('idle-A', 2)
+        with k.get_slot('slot-1') as got:
+            assert got
+            time.sleep(1.5)
+            # Ids in use don't expire.
+            assert 'idle-A' in master.objects
+        assert wait_until(lambda: 'idle-A' not in n1.objects, timeout=3)
+        self.assertEqual(master.stats['expired'], 1)
+        self.assertEqual((k.slots, k.workers), (0, 0))
+
+        # The keeper still in use gets the updates when the id comes back.
+        with n1.get('idle-A', 2).get_slot('slot-1') as got:
+            assert got
+            assert n1.objects['idle-A'] is k
+            assert wait_until(lambda: k.workers == 1)
+        master.stop()
+        n1.stop()
+
+    def test_delta_responses(self):
+        master = SlotKeeper(rpc, 'delta', shard='delta', coalesce=0.1, delta=True)
+        n1 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'delta', 'delta-1', shard='delta')
+        n2 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'delta', 'delta-2', shard='delta')
+        n1k = n1.get('delta-A', 0)
+        n2k = n2.get('delta-A', 0)
+        x = n2k.get_slot('x')
+        assert x.acquire()
+        assert wait_until(lambda: n1k.slots == 1)
+        with n1k.get_slot('y') as got:
+            assert got
+            self.assertEqual((n1k.slots, n1k.workers), (2, 2))
+            # The coalesced patch is relative to the pushed 1/1, not to the
+            # 2/2 of the acquire response.
+            x.release()
+            time.sleep(0.3)
+            self.assertEqual((n1k.slots, n1k.workers), (1, 1))
+            self.assertEqual((n2k.slots, n2k.workers), (1, 1))
+        assert wait_until(lambda: (n1k.slots, n1k.workers) == (0, 0))
+        master.stop()
+        n1.stop()
+        n2.stop()
+
+    def _recount(self, master):
+        objects = master.objects.values()
+        return {
+            'slots': sum(len(obj.slots) for obj in objects),
+            'workers': sum(obj.workers for obj in objects),
+            'units': sum(obj.units.used for obj in objects),
+        }
+
+    def _counters(self, master):
+        counters = master.get_server_counters()
+        return dict((key, counters[key]) for key in ('slots', 'workers', 'units'))
+
+    def test_counters(self):
+        master = SlotKeeper(rpc, 'counters', shard='counters')
+        n1 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'counters', 'counters-client', shard='counters')
+        a = n1.get('counters-A', 2, 10)
+        b = n1.get('counters-B', 0, 10)
+        with a.get_slot('slot-1'), a.get_slot('slot-1'), a.get_slot('slot-2'), b.get_slot():
+            with a.get_units(3), b.get_units(4):
+                units = b.get_units(2)
+                assert units.acquire()
+                units.release(1)
+                self.assertEqual(self._counters(master), {'slots': 3, 'workers': 4, 'units': 8})
+                self.assertEqual(self._counters(master), self._recount(master))
+                units.release()
+            # Full ids don't change the counters.
+            with a.get_slot('slot-3') as got:
+                assert not got
+            self.assertEqual(self._counters(master), {'slots': 3, 'workers': 4, 'units': 0})
+            self.assertEqual(self._counters(master), self._recount(master))
+        assert wait_until(lambda: self._counters(master) == {'slots': 0, 'workers': 0, 'units': 0})
+        self.assertEqual(self._counters(master), self._recount(master))
+        master.stop()
+        n1.stop()
+
+    def test_idle_rejected_units(self):
+        master = SlotKeeper(rpc, 'idle-units', idle_timeout=0.5, shard='idle-units')
+        n1 = SlotKeeper(AZRPC(rpc_name, rpc_port), 'idle-units', 'idle-units-client', shard='idle-units')
+        for id in ('rejected-A', 'rejected-B', 'rejected-C'):
+            with n1.get(id, 0, 10).get_units(11) as got:
+                assert not got
+        self.assertEqual(len(master.objects), 3)
+        assert wait_until(lambda: not master.objects, timeout=3)
+        self.assertEqual(master.stats['expired'], 3)
+        master.stop()
+        n1.stop()
+
+    def test_sharded_units(self):
+        masters = [SlotKeeper(rpc, 'sharded', shard=key) for key in ('sharded-a', 'sharded-b')]
+        sharded = ShardedSlotKeeper(AZRPC(rpc_name, rpc_port), 'sharded', 'sharded-client')
+        sharded.add_target(None, key='sharded-a')
+        sharded.add_target(None, key='sharded-b')
+        k = sharded.get('sharded-units', 0, 10)
+        with k.get_units(4) as got:
+            assert got
+            self.assertEqual((k.max_units, k.units), (10, 4))
+        sharded.stop()
+        for master in masters:
+            master.stop()
+
+    def test_units(self):
+        n1k = self.n1.get('units', 0, 10)
+        n2k = self.n2.get('units', 0, 10)
+        with n1k.get_units(6) as got:
+            assert got
+            self.assertEqual(n1k.units, 6)
+            with n2k.get_units(5, try_=True) as got:
+                assert not got
+            with n2k.get_units(11, timeout=1) as got:
+                assert not got
+            units = n2k.get_units(4)
+            assert units.acquire()
+            self.assertEqual(n2k.units, 10)
+            units.release(1)
+            self.assertEqual(n2k.units, 9)
+            units.release()
+            self.assertEqual(n2k.units, 6)
+
+            # A queued acquire is cancelled when the client goes away.
+            group = Group()
+            group.spawn(Units(n2k, 5).acquire)
+            master_units = self.master.objects['units'].units
+            assert wait_until(lambda: master_units.waiters == 1)
+            group.kill()
+            assert wait_until(lambda: master_units.waiters == 0)
+        self.assertEqual(master_units.used, 0)
+        print self.master.get_server_stats()
+
+    def test_leased_units(self):
+        n1k = self.n1.get('leased', 0, 10)
+        n2k = self.n2.get('leased', 0, 10)
+        leased = n1k.get_leased_units(block=4, idle_timeout=0.2)
+        assert leased.acquire(1)
+        master_units = self.master.objects['leased'].units
+        self.assertEqual((leased.leased, leased.used, master_units.used), (4, 1, 4))
+        assert leased.acquire(2)
+        self.assertEqual((leased.leased, leased.used, master_units.used), (4, 3, 4))
+        assert leased.acquire(5)
+        self.assertEqual((leased.leased, leased.used, master_units.used), (8, 8, 8))
+
+        # A waiting follower gets the units once they are free again.
+        units = n2k.get_units(5)
+        group = Group()
+        group.spawn(units.acquire)
+        assert wait_until(lambda: master_units.waiters == 1)
+        leased.release(6)
+        group.join()
+        assert units.got
+        assert wait_until(lambda: leased.leased == 2)
+        self.assertEqual((leased.used, master_units.used), (2, 7))
+        units.release()
+
+        # Failed returns keep the units leased.
+        release_units = self.n1._release_units_execute
+        self.n1._release_units_execute = lambda *args: 1 / 0
+        try:
+            assert leased.acquire(4, timeout=1)
+            self.assertEqual(leased.leased, 6)
+            leased.release(5)
+            # The full lease goes back by closing its stream, the partial
+            # return of the other one fails.
+            leased._return_free()
+            self.assertEqual((leased.leased, leased.used, leased.free), (2, 1, 1))
+        finally:
+            self.n1._release_units_execute = release_units
+        leased._return_free()
+        self.assertEqual((leased.leased, leased.used, leased.free), (1, 1, 0))
+        leased.release(1)
+        assert wait_until(lambda: leased.leased == 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test(self):
+        master = RateLimiter(rpc, 'test-ratelimit', rate=1, capacity=5)
+        limiter = RateLimiter(AZRPC(rpc_name, rpc_port), 'test-ratelimit', 'some-account-or-something', rate=1, capacity=5)
+
+        self.assertEqual([limiter.consume('foo') for _ in xrange(6)], [True] * 5 + [False])
+        self.assertEqual(limiter.consume_many([('bar', 3), ('bar', 3), ('baz', 1)]), [True, False, True])
+        with limiter.get_tokens('lease', block=4) as tokens:
+            assert tokens.consume()
+            self.assertEqual(tokens.tokens, 3)
+        time.sleep(0.5)
+        assert limiter.available('foo') < 1
         print master.get_server_stats()
 
+    def test_set_limit(self):
+        master = RateLimiter(rpc, 'test-ratelimit-limit', rate=10)
+        limiter = RateLimiter(AZRPC(rpc_name, rpc_port), 'test-ratelimit-limit', 'some-account-or-something', rate=10)
+
+        self.assertEqual(limiter.consume('foo', 10), True)
+        limiter.set_limit('foo', 1, 10)
+        time.sleep(2.5)
+        granted = limiter.consume_many([('foo', 1)] * 10).count(True)
+        assert 2 <= granted <= 3, granted
+        print master.get_server_stats()
+
+    def test_sharded(self):
+        masters = dict((key, RateLimiter(rpc, 'test-ratelimit-sharded', rate=1, capacity=3, shard=key))
+                       for key in ('shard-a', 'shard-b'))
+        limiter = ShardedRateLimiter(AZRPC(rpc_name, rpc_port), 'test-ratelimit-sharded', 'some-account-or-something',
+                                     rate=1, capacity=3)
+        for key in masters:
+            limiter.add_target(None, key=key)
+        keys = ['key-%d' % i for i in xrange(6)]
+        self.assertEqual(limiter.consume_many([(key, 3) for key in keys]), [True] * 6)
+        self.assertEqual(limiter.consume_many([(key, 1) for key in keys]), [False] * 6)
+        # Every key only has a bucket on its own server.
+        for key in keys:
+            for shard_key, master in masters.iteritems():
+                self.assertEqual(key in master.objects, shard_key == limiter.ring.get(key))
+        assert set(limiter.ring.get(key) for key in keys) == set(masters)
+        limiter.stop()
+        for master in masters.values():
+            master.stop()
+
+
+class TestHashRing(unittest.TestCase):
+    keys = ['key-%d' % i for i in xrange(10000)]
+
+    def mapping(self, ring):
+        return dict((key, ring.get(key)) for key in self.keys)
+
+    def test_stable(self):
+        a = self.mapping(HashRing(['a', 'b', 'c']))
+        self.assertEqual(self.mapping(HashRing(['c', 'a', 'b'])), a)
+        self.assertEqual(a['key-1'], HashRing(['a', 'b', 'c']).get(u'key-1'))
+        self.assertEqual(HashRing(['a', 'b', 'c']).get(42), HashRing(['a', 'b', 'c']).get('42'))
+        assert HashRing(['a', 'b', 'c']).get(('key', 1)) in 'abc'
+        self.assertEqual(set(a.values()), set('abc'))
+
+    def test_add_remove(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = self.mapping(ring)
+        ring.add('d')
+        after = self.mapping(ring)
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertEqual(set(after[key] for key in moved), set('d'))
+        assert 0.15 < len(moved) / float(len(self.keys)) < 0.35, len(moved)
+        ring.remove('d')
+        self.assertEqual(self.mapping(ring), before)
+        self.assertEqual(len(ring), 3)
+
+    def test_weights(self):
+        ring = HashRing()
+        ring.add('a')
+        ring.add('b', 3)
+        share = self.mapping(ring).values().count('b') / float(len(self.keys))
+        assert 0.65 < share < 0.85, share
+        ring.remove('b')
+        self.assertEqual(set(self.mapping(ring).values()), set('a'))
+
+    def test_shard_names(self):
+        sharded = ShardedRPCLock(AZRPC(rpc_name, rpc_port), 'test-shards', ['target-a', 'target-b'])
+        self.assertEqual(sorted(shard.name for shard in sharded.shards.values()),
+                         ['azsync.lock.test-shards/target-a', 'azsync.lock.test-shards/target-b'])
+
+
+class TestWorkers(unittest.TestCase):
+    def test_sum_counters(self):
+        totals = sum_counters([
+            {'lock': {'requests': 1, 'active': 2}},
+            {'lock': {'requests': 3, 'active': 0}, 'slot': {'requests': 1}},
+        ])
+        self.assertEqual(totals, {'lock': {'requests': 4, 'active': 2}, 'slot': {'requests': 1}})
+
+    def test_partitions(self):
+        Partitions(rpc, [rpc_port + 1, rpc_port + 2], prefix='host-a:%d' % rpc_port)
+        sharded = add_workers(ShardedRPCLock(AZRPC(rpc_name, rpc_port), 'test-partitions'), rpc_name)
+        self.assertEqual(sorted(sharded.shards), ['host-a:9999/worker-0', 'host-a:9999/worker-1'])
+        assert sharded.ring.get('some-lock') in sharded.shards
+
 
 def main():
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,78 @@
+import logging
+
+from time import time
+from gevent import spawn, sleep
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel(object):
+    """Hashed timer wheel which expires any number of objects with a single
+    greenlet. Objects need writable `expires` and `wheel_slot` attributes.
+
+    Pushing `expires` further out doesn't touch the wheel, the object is moved
+    to its new slot when its old one comes up. `callback` is called with every
+    object whose `expires` has passed.
+    """
+    def __init__(self, callback, resolution=1.0, size=512):
+        self.callback = callback
+        self.resolution = resolution
+        self.size = size
+        self.slots = [set() for _ in xrange(size)]
+        self.tick = int(time() / resolution)
+        self.count = 0
+        self.greenlet = None
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, expires):
+        return max(int(expires / self.resolution), self.tick) % self.size
+
+    def add(self, obj):
+        obj.wheel_slot = self._slot(obj.expires)
+        self.slots[obj.wheel_slot].add(obj)
+        self.count += 1
+        if self.greenlet is None:
+            self.greenlet = spawn(self._run)
+
+    def discard(self, obj):
+        slot = self.slots[obj.wheel_slot]
+        if obj in slot:
+            slot.remove(obj)
+            self.count -= 1
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def _run(self):
+        while True:
+            sleep(self.resolution)
+            now = time()
+            last = int(now / self.resolution)
+            while self.tick <= last:
+                slot = self.slots[self.tick % self.size]
+                self.tick += 1
+                if slot:
+                    self._expire(slot, now)
+
+    def _expire(self, slot, now):
+        expired = []
+        for obj in list(slot):
+            if obj.expires <= now:
+                slot.remove(obj)
+                self.count -= 1
+                expired.append(obj)
+            else:
+                wheel_slot = self._slot(obj.expires)
+                if wheel_slot != obj.wheel_slot:
+                    slot.remove(obj)
+                    obj.wheel_slot = wheel_slot
+                    self.slots[wheel_slot].add(obj)
+        for obj in expired:
+            try:
+                self.callback(obj)
+            except Exception:
+                logger.exception('Exception while expiring %r', obj)
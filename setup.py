@@ -10,6 +10,7 @@ setup(
     ],
     install_requires=[
         'azrpc>=1.0.1',
+        'msgpack>=0.5.2',
     ],
     dependency_links=[
         'https://github.com/max0d41/azrpc/archive/master.zip#egg=azrpc-1.0.1',